@@ -0,0 +1,522 @@
+##asyncio implementation of the ReliableClient/ReliableServer protocol##
+##pakcet types: 0-> data, 1-> SYN, 2-> SYNACK, 3-> Ack, 4-> FIN, 5-> FINACK, 6-> data with piggybacked Ack##
+import asyncio
+import ipaddress
+import socket
+
+from packet import MIN_LEN, SEQ_NUM, HeaderTemplate, Packet
+from ReliableServer import CLIENT_IDLE
+from ReliableTransport import (MAX_RETRIES, MAX_RTO, MAX_SEGMENT_SIZE, AddStats, CongestionWindow, ConnectionStats,
+                               DelayedAck, HandshakeOptions, NegotiatedSegmentSize, ReceiveWindow, RTTEstimator,
+                               SendWindow, SplitPiggybackedAck)
+
+# the side that sends the last FINACK lingers at least one peer retransmission timeout
+TIME_WAIT = MAX_RTO
+
+
+class ReliableDatagramProtocol(asyncio.DatagramProtocol):
+    """
+    ReliableDatagramProtocol decodes every datagram of an endpoint and hands the packet to its owner.
+    """
+
+    def __init__(self, packetHandler):
+        self.packetHandler = packetHandler
+
+    def datagram_received(self, data, addr):
+        try:
+            packet = Packet.from_bytes(data)
+        except ValueError as e:
+            print(e)
+            return
+        self.packetHandler(packet, addr)
+
+    def error_received(self, exc):
+        print(exc)
+
+
+class AsyncReliableConnection:
+    """
+    AsyncReliableConnection is one end of a reliable connection driven by an asyncio event loop.
+    Retransmissions, FIN retries and TIME WAIT are loop timers and every state change resolves a future,
+    so a single loop drives any number of connections without threads or sleeping.
+    """
+
+    def __init__(self, transport, sendAddress, peerAddress, peerPort, segmentSize, timeoutInterval):
+        self.loop = asyncio.get_running_loop()
+        self.transport = transport
+        # where packets are sent to, i.e. the router
+        self.sendAddress = sendAddress
+        self.peerAddress = peerAddress
+        self.peerPort = peerPort
+        self.segmentSize = segmentSize
+        # header of our data packets, only the sequence number is patched in per segment
+        self.dataHeader = HeaderTemplate(0, peerAddress, peerPort)
+        # data packets carrying our cumulative ACK number in front of the data
+        self.dataAckHeader = HeaderTemplate(6, peerAddress, peerPort)
+        self.rttEstimator = RTTEstimator(timeoutInterval)
+        self.congestionWindow = CongestionWindow()
+        self.sendWindow = SendWindow(segmentSize, self.rttEstimator, self.congestionWindow)
+        # resolved whenever everything appended so far is acknowledged
+        self.sendDone = self.loop.create_future()
+        self.sendDone.set_result(None)
+        self.retransmissionTimer = None
+        self.retransmissionDeadline = None
+        self.receiveWindow = ReceiveWindow()
+        self.delayedAck = DelayedAck()
+        # sends the held back ACK at the delayedAck deadline
+        self.ackTimer = None
+        self.peerFin = self.loop.create_future()
+        # resolved when in-order data arrives for a waiting stream()
+        self.dataReady = None
+        self.finAcked = self.loop.create_future()
+        self.closed = self.loop.create_future()
+        self.timeWaitTimer = None
+        # ConnectionError of a peer that stopped answering, every further send fails with it
+        self.peerGone = None
+        self.stats = ConnectionStats()
+
+    def SingleSend(self, packetType, seq_num, data):
+        p = Packet(packet_type=packetType,
+                   seq_num=seq_num,
+                   peer_ip_addr=self.peerAddress,
+                   peer_port=self.peerPort,
+                   payload=data)
+        datagram = p.to_bytes()
+        self.transport.sendto(datagram, self.sendAddress)
+        self.stats.Sent(len(datagram))
+
+    def GetStats(self):
+        """
+        GetStats returns the counters and gauges of the connection, see ConnectionStats.Snapshot.
+        """
+        stats = self.stats.Snapshot(self.rttEstimator, self.congestionWindow, self.sendWindow, self.receiveWindow)
+        stats['peer'] = '%s:%d' % (self.peerAddress, self.peerPort)
+        return stats
+
+    async def RetryUntil(self, future, packetType, seq_num, payload=b''):
+        """
+        RetryUntil sends a control packet and repeats it with the backed off RTO until future resolves.
+        The RTT is sampled only when the first transmission got answered (Karn's rule).
+        Returns False when the peer did not answer MAX_RETRIES retransmissions.
+        """
+        for attempt in range(MAX_RETRIES + 1):
+            sentAt = self.loop.time()
+            self.SingleSend(packetType, seq_num, payload)
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.rttEstimator.Timeout())
+            except asyncio.TimeoutError:
+                self.rttEstimator.Backoff()
+                continue
+            if attempt == 0:
+                self.rttEstimator.AddSample(self.loop.time() - sentAt)
+            return True
+        return False
+
+    async def send(self, data):
+        """
+        send streams data (str, bytes, file object or iterable of chunks) to the peer and returns once every segment
+        is acknowledged. It can be called repeatedly, the data of consecutive calls follows each other on the stream.
+        Raises ConnectionError when the peer stopped answering, like ReliableConnection.Send.
+        """
+        if self.peerGone is not None:
+            raise self.peerGone
+        self.sendWindow.Append(data)
+        if self.sendDone.done():
+            self.sendDone = self.loop.create_future()
+        self.Pump()
+        await self.sendDone
+
+    async def recv(self):
+        """
+        recv returns everything the peer sent, as soon as its FIN arrives.
+        """
+        await self.peerFin
+        return self.receiveWindow.Take()
+
+    async def stream(self):
+        """
+        stream is an async iterator over the received bytes: it yields every chunk of in-order data
+        as soon as it arrives instead of waiting for the peer's FIN, and stops after the FIN.
+        """
+        while True:
+            chunk = self.receiveWindow.Take()
+            if chunk:
+                yield chunk
+            elif self.peerFin.done():
+                return
+            else:
+                self.dataReady = self.loop.create_future()
+                await asyncio.wait((self.dataReady, self.peerFin), return_when=asyncio.FIRST_COMPLETED)
+
+    async def close(self):
+        """
+        close sends FIN once all data is acknowledged and returns when the peer acknowledged it,
+        or gave no answer to any of the retransmissions.
+        """
+        try:
+            await self.sendDone
+        except ConnectionError:
+            # send reports it
+            pass
+        if self.peerGone is not None:
+            # given up on already, nobody would answer the FIN
+            return
+        self.stats.TeardownStarted()
+        # the FIN carries our cumulative ACK number like any ACK
+        self.CancelAckTimer()
+        if not await self.RetryUntil(self.finAcked, 4, self.GetAckNumber()):
+            # the peer is gone, there is nobody left to wait for
+            self.finAcked.set_result(None)
+            if not self.peerFin.done():
+                self.peerFin.set_result(None)
+        self.stats.Closed()
+        self.MaybeClosed()
+
+    def Pump(self):
+        if self.sendWindow.stalledRounds > MAX_RETRIES:
+            # MAX_RETRIES backed off timeouts in a row got no ACK
+            self.GiveUp(ConnectionError("no ACK from {}:{}".format(self.peerAddress, self.peerPort)))
+            return
+        now = self.loop.time()
+        # selective repeat and congestion window decide what goes on the wire
+        for seq in self.sendWindow.SegmentsToSend(now):
+            payload = self.sendWindow.Payload(seq)
+            if self.delayedAck.Piggyback(len(payload)):
+                # the ACK we hold back rides on the segment instead of a packet of its own
+                self.CancelAckTimer()
+                datagram = self.dataAckHeader.datagram(seq, SEQ_NUM.pack(self.GetAckNumber()) + payload)
+                self.stats.piggybackedAcks += 1
+            else:
+                datagram = self.dataHeader.datagram(seq, payload)
+            self.transport.sendto(datagram, self.sendAddress)
+            self.stats.Sent(len(datagram))
+            self.sendWindow.MarkSent(seq, now)
+
+        if self.sendWindow.Finished():
+            self.CancelRetransmissionTimer()
+            if not self.sendDone.done():
+                self.sendDone.set_result(None)
+            return
+
+        # a single loop timer, armed at the nearest per-segment deadline
+        deadline = self.sendWindow.NextDeadline()
+        if deadline != self.retransmissionDeadline:
+            self.CancelRetransmissionTimer()
+            if deadline is not None:
+                self.retransmissionDeadline = deadline
+                self.retransmissionTimer = self.loop.call_at(deadline, self.OnRetransmissionTimer)
+
+    def OnRetransmissionTimer(self):
+        self.retransmissionTimer = None
+        self.retransmissionDeadline = None
+        self.Pump()
+
+    def CancelRetransmissionTimer(self):
+        if self.retransmissionTimer is not None:
+            self.retransmissionTimer.cancel()
+        self.retransmissionTimer = None
+        self.retransmissionDeadline = None
+
+    def GetAckNumber(self):
+        return self.receiveWindow.AckNumber()
+
+    def SendAck(self):
+        self.CancelAckTimer()
+        self.stats.acksSent += 1
+        # payload carries the SACK bitmap of out-of-order segments already received
+        self.SingleSend(3, self.GetAckNumber(), self.receiveWindow.SackPayload())
+
+    def CancelAckTimer(self):
+        self.delayedAck.Sent()
+        if self.ackTimer is not None:
+            self.ackTimer.cancel()
+        self.ackTimer = None
+
+    def ReceiveSegment(self, seq_num, payload):
+        """
+        ReceiveSegment stores a data segment and acknowledges it right away or at the delayedAck deadline,
+        see DelayedAck.
+        """
+        hadGap = self.receiveWindow.HasGap()
+        inserted = self.receiveWindow.Insert(seq_num, payload)
+        if inserted and self.receiveWindow.Available():
+            if self.dataReady is not None and not self.dataReady.done():
+                self.dataReady.set_result(None)
+        immediate = not inserted or hadGap or self.receiveWindow.HasGap() or len(payload) < self.segmentSize
+        if self.delayedAck.OnSegment(immediate, self.loop.time()):
+            self.SendAck()
+        elif self.ackTimer is None:
+            self.ackTimer = self.loop.call_at(self.delayedAck.deadline, self.SendAck)
+
+    def MaybeClosed(self, lastFinAck=False):
+        if self.finAcked.done() and self.peerFin.done() and not self.closed.done():
+            self.closed.set_result(None)
+            if lastFinAck:
+                # our FINACK may get lost, keep answering retransmitted FINs for a while (TIME WAIT)
+                self.timeWaitTimer = self.loop.call_later(TIME_WAIT, self.OnTimeWaitExpired)
+            else:
+                self.OnTimeWaitExpired()
+
+    def OnTimeWaitExpired(self):
+        pass
+
+    def GiveUp(self, error):
+        """
+        GiveUp ends a connection whose peer stopped answering: a waiting send fails with error, recv, stream and
+        close return, and the connection is released without TIME WAIT.
+        """
+        if self.peerGone is not None:
+            return
+        self.peerGone = error
+        self.CancelRetransmissionTimer()
+        self.CancelAckTimer()
+        if not self.sendDone.done():
+            self.sendDone.set_exception(error)
+        for future in (self.peerFin, self.finAcked):
+            if not future.done():
+                future.set_result(None)
+        self.stats.Closed()
+        self.MaybeClosed()
+
+    def HandlePacket(self, packet):
+        self.stats.Received(MIN_LEN + len(packet.payload))
+        # ACK
+        if packet.packet_type == 3:
+            if not self.sendWindow.Finished():
+                self.sendWindow.Acknowledge(packet.seq_num, packet.payload, self.loop.time())
+                self.Pump()
+
+        # data
+        elif packet.packet_type == 0:
+            self.ReceiveSegment(packet.seq_num, packet.payload)
+
+        # data with the peer's cumulative ACK number piggybacked
+        elif packet.packet_type == 6:
+            ackNumber, payload = SplitPiggybackedAck(packet.payload)
+            if not self.sendWindow.Finished():
+                self.sendWindow.Acknowledge(ackNumber, b'', self.loop.time(), pure=False)
+                self.Pump()
+            self.ReceiveSegment(packet.seq_num, payload)
+
+        # FIN
+        elif packet.packet_type == 4:
+            self.SingleSend(5, self.GetAckNumber(), ''.encode())
+            # the FIN acknowledges our data too, in case the peer's last ACK got lost
+            if not self.sendWindow.Finished():
+                self.sendWindow.Acknowledge(packet.seq_num, b'', self.loop.time(), pure=False)
+                self.Pump()
+            if not self.peerFin.done():
+                self.peerFin.set_result(None)
+                self.MaybeClosed(lastFinAck=True)
+            elif self.timeWaitTimer is not None:
+                # retransmitted FIN, restart TIME WAIT
+                self.timeWaitTimer.cancel()
+                self.timeWaitTimer = self.loop.call_later(TIME_WAIT, self.OnTimeWaitExpired)
+
+        # FINACK
+        elif packet.packet_type == 5:
+            if not self.finAcked.done():
+                self.finAcked.set_result(None)
+
+
+class AsyncReliableClient(AsyncReliableConnection):
+    """
+    AsyncReliableClient opens its own UDP endpoint towards the router and connects to one server.
+    """
+
+    def __init__(self, routerAddress, routerPort, peerAddress, peerPort, segmentSize=None, timeoutInterval=0.5):
+        self.routerAddress = routerAddress
+        self.routerPort = routerPort
+        self.peerAddress = ipaddress.ip_address(socket.gethostbyname(peerAddress))
+        self.peerPort = peerPort
+        # largest segment we accept, the one actually sent with is agreed on in the handshake
+        self.maxSegmentSize = segmentSize or MAX_SEGMENT_SIZE
+        self.segmentSize = self.maxSegmentSize
+        self.timeoutInterval = timeoutInterval
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            lambda: ReliableDatagramProtocol(self.OnPacket), family=socket.AF_INET)
+        AsyncReliableConnection.__init__(self, transport, (self.routerAddress, self.routerPort),
+                                         self.peerAddress, self.peerPort, self.segmentSize, self.timeoutInterval)
+        self.synAcked = self.loop.create_future()
+        if not await self.RetryUntil(self.synAcked, 1, 0, HandshakeOptions(self.maxSegmentSize)):
+            self.transport.close()
+            raise ConnectionError("no SYNACK from {}:{}".format(self.peerAddress, self.peerPort))
+        self.segmentSize = NegotiatedSegmentSize(self.maxSegmentSize, self.synAcked.result())
+        self.sendWindow.segmentSize = self.segmentSize
+        # the SYN backoff only reflects the handshake losses, data starts from the unbacked-off timeout
+        self.rttEstimator.ResetBackoff()
+        # complete the handshake
+        self.SingleSend(2, 0, ''.encode())
+        self.stats.Established()
+
+    def OnPacket(self, packet, addr):
+        # SYNACK
+        if packet.packet_type == 2:
+            self.stats.Received(MIN_LEN + len(packet.payload))
+            if not self.synAcked.done():
+                # the payload carries the server's handshake options
+                self.synAcked.set_result(bytes(packet.payload))
+        else:
+            self.HandlePacket(packet)
+
+    def OnTimeWaitExpired(self):
+        self.transport.close()
+
+    async def Transfer(self, data):
+        """
+        Transfer is the request/response exchange of ReliableClient.Transfer on the event loop.
+        """
+        await self.connect()
+        await self.send(data)
+        await self.close()
+        receivedData = await self.recv()
+        return receivedData.decode()
+
+
+class AsyncServerConnection(AsyncReliableConnection):
+    """
+    AsyncServerConnection is one peer of an AsyncReliableServer.
+    """
+
+    def __init__(self, server, sendAddress, peerAddress, peerPort):
+        AsyncReliableConnection.__init__(self, server.transport, sendAddress, peerAddress, peerPort,
+                                         server.segmentSize, server.timeoutInterval)
+        self.server = server
+        self.synCount = 0
+        self.synAckSentAt = None
+        # last packet from the client, the idle timer expires the connection CLIENT_IDLE seconds after it
+        self.lastHeard = self.loop.time()
+        self.idleTimer = self.loop.call_at(self.lastHeard + CLIENT_IDLE, self.OnIdleTimer)
+
+    def OnIdleTimer(self):
+        # re-armed from the last packet instead of on every packet
+        self.idleTimer = None
+        if self.closed.done() or self.peerFin.done():
+            # the request is complete, send and close give up on a silent client by themselves
+            return
+        idleUntil = self.lastHeard + CLIENT_IDLE
+        if self.loop.time() < idleUntil:
+            self.idleTimer = self.loop.call_at(idleUntil, self.OnIdleTimer)
+            return
+        # the client fell silent before or in the middle of its request, e.g. after its SYN only
+        print("Client went silent, connection expired")
+        self.GiveUp(ConnectionError("{}:{} went silent".format(self.peerAddress, self.peerPort)))
+
+    def OnPacket(self, packet):
+        self.lastHeard = self.loop.time()
+        # SYN, first or repeated because the SYNACK got lost
+        if packet.packet_type == 1:
+            self.stats.Received(MIN_LEN + len(packet.payload))
+            self.synCount += 1
+            self.segmentSize = NegotiatedSegmentSize(self.server.segmentSize, packet.payload)
+            self.sendWindow.segmentSize = self.segmentSize
+            self.SingleSend(2, 0, HandshakeOptions(self.server.segmentSize))
+            # Karn's rule: when the SYN is repeated the echoed SYNACK can not be timed
+            self.synAckSentAt = self.loop.time() if self.synCount == 1 else None
+
+        # SYNACK echo, completes the handshake
+        elif packet.packet_type == 2:
+            self.stats.Received(MIN_LEN + len(packet.payload))
+            self.stats.Established()
+            if self.synAckSentAt is not None:
+                self.rttEstimator.AddSample(self.loop.time() - self.synAckSentAt)
+                self.synAckSentAt = None
+
+        else:
+            if packet.packet_type in (0, 6):
+                # the SYNACK echo may have been lost
+                self.stats.Established()
+            self.HandlePacket(packet)
+
+    def OnTimeWaitExpired(self):
+        if self.idleTimer is not None:
+            self.idleTimer.cancel()
+            self.idleTimer = None
+        self.server.RemoveConnection(self)
+
+
+class AsyncReliableServer:
+    """
+    AsyncReliableServer serves every peer from one UDP endpoint, demultiplexing on the packet peer address.
+    connectionHandler is a coroutine function called with each new AsyncServerConnection.
+    """
+
+    def __init__(self, serverport, segmentSize=None, timeoutInterval=0.5):
+        self.serverPort = serverport
+        # largest segment accepted, each connection sends with the smaller of it and the client's MSS
+        self.segmentSize = segmentSize or MAX_SEGMENT_SIZE
+        self.timeoutInterval = timeoutInterval
+        self.transport = None
+        self.connectionHandler = None
+        # (peer_ip_addr, peer_port) -> AsyncServerConnection
+        self.connections = {}
+        # counters summed over the connections already removed, see GetStats
+        self.closedStats = {}
+        self.closedConnections = 0
+
+    async def start(self, connectionHandler):
+        loop = asyncio.get_running_loop()
+        self.connectionHandler = connectionHandler
+        self.transport, protocol = await loop.create_datagram_endpoint(
+            lambda: ReliableDatagramProtocol(self.OnPacket), local_addr=('0.0.0.0', self.serverPort))
+        print("Server is listening at port: ", self.serverPort)
+
+    def close(self):
+        self.transport.close()
+
+    def RemoveConnection(self, serverConnection):
+        key = (serverConnection.peerAddress, serverConnection.peerPort)
+        if self.connections.get(key) is serverConnection:
+            del self.connections[key]
+            AddStats(self.closedStats, serverConnection.GetStats())
+            self.closedConnections += 1
+
+    def GetStats(self):
+        """
+        GetStats returns the stats of every open connection and the counters summed over all connections,
+        the closed ones included.
+        """
+        snapshots = [serverConnection.GetStats() for serverConnection in self.connections.values()]
+        totals = dict(self.closedStats)
+        for snapshot in snapshots:
+            AddStats(totals, snapshot)
+        return {'openConnections': len(snapshots), 'closedConnections': self.closedConnections, 'totals': totals,
+                'connections': snapshots}
+
+    def OnPacket(self, packet, addr):
+        key = (packet.peer_ip_addr, packet.peer_port)
+        serverConnection = self.connections.get(key)
+        if serverConnection is None and packet.packet_type == 1:
+            serverConnection = AsyncServerConnection(self, addr, packet.peer_ip_addr, packet.peer_port)
+            self.connections[key] = serverConnection
+            serverConnection.loop.create_task(self.connectionHandler(serverConnection))
+
+        if serverConnection is not None:
+            serverConnection.OnPacket(packet)
+
+        # FIN of a connection that is already closed, its FINACK got lost
+        elif packet.packet_type == 4:
+            p = Packet(packet_type=5,
+                       seq_num=packet.seq_num,
+                       peer_ip_addr=packet.peer_ip_addr,
+                       peer_port=packet.peer_port,
+                       payload=''.encode())
+            self.transport.sendto(p.to_bytes(), addr)
+
+
+# async def ServerHandler(serverConnection):
+#     data = await serverConnection.recv()
+#     await serverConnection.send('Hi mohamed! This is the Server. You sent: ' + data.decode())
+#     await serverConnection.close()
+#
+#
+# async def Main():
+#     server = AsyncReliableServer(8007, 3)
+#     await server.start(ServerHandler)
+#     client = AsyncReliableClient('localhost', 3000, 'localhost', 8007, 3)
+#     print(await client.Transfer('hello ahmed I am Mohamed!'))
+#
+# asyncio.run(Main())
@@ -0,0 +1,103 @@
+##bounded pool of kept-alive ReliableClient connections, shared by the threads of httpc's batch mode##
+import threading
+
+from ReliableClient import ReliableClient
+from ReliableTransport import StreamReader
+
+
+class PooledConnection:
+    """
+    PooledConnection is one open connection of a ConnectionPool with the reader over its byte stream.
+    """
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.reader = StreamReader(client.ReceiveStream())
+        # number of exchanges done over the connection
+        self.uses = 0
+
+
+class ConnectionPool:
+    """
+    ConnectionPool hands out open connections per (hostName, port) and takes them back for reuse.
+    At most maxPerHost connections to the same server exist at once, further Acquire calls wait for a Release.
+    """
+
+    def __init__(self, routerAddress, routerPort, maxPerHost=4, segmentSize=None):
+        self.routerAddress = routerAddress
+        self.routerPort = routerPort
+        self.maxPerHost = maxPerHost
+        self.segmentSize = segmentSize
+        # (hostName, port) -> PooledConnections waiting for reuse
+        self.idle = {}
+        # (hostName, port) -> number of open connections, idle or in use
+        self.open = {}
+        self.opened = 0
+        self.condition = threading.Condition()
+
+    def Acquire(self, hostName, port):
+        key = (hostName, port)
+        stale = []
+        connection = None
+        with self.condition:
+            while True:
+                idle = self.idle.get(key)
+                if idle:
+                    # the server closes a connection that idles too long, one whose FIN arrived is dropped,
+                    # nothing was sent on it yet
+                    closed = [pooled for pooled in idle if pooled.client.peerClosed]
+                    if closed:
+                        idle[:] = [pooled for pooled in idle if not pooled.client.peerClosed]
+                        self.open[key] -= len(closed)
+                        stale += closed
+                if idle:
+                    connection = idle.pop()
+                    break
+                if self.open.get(key, 0) < self.maxPerHost:
+                    self.open[key] = self.open.get(key, 0) + 1
+                    self.opened += 1
+                    break
+                self.condition.wait()
+
+        # close outside the lock, the FIN exchange takes a round trip
+        for pooled in stale:
+            pooled.client.Close()
+        if connection is not None:
+            return connection
+
+        # connect outside the lock, the handshake takes at least a round trip
+        try:
+            client = ReliableClient(self.routerAddress, self.routerPort, hostName, port, self.segmentSize)
+            client.Connect()
+        except Exception:
+            self.Forget(key)
+            raise
+        return PooledConnection(key, client)
+
+    def Release(self, connection, reusable=True):
+        """
+        Release returns a connection to the pool. A connection that is not reusable,
+        e.g. after "Connection: close" or an error, is closed and frees its slot instead.
+        """
+        connection.uses += 1
+        if not reusable:
+            connection.client.Close()
+            self.Forget(connection.key)
+            return
+        with self.condition:
+            self.idle.setdefault(connection.key, []).append(connection)
+            self.condition.notify()
+
+    def Forget(self, key):
+        with self.condition:
+            self.open[key] -= 1
+            self.condition.notify()
+
+    def Close(self):
+        with self.condition:
+            connections = [connection for idle in self.idle.values() for connection in idle]
+            self.idle.clear()
+        for connection in connections:
+            connection.client.Close()
+            self.Forget(connection.key)
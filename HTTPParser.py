@@ -0,0 +1,128 @@
+##incremental HTTP/1.1 message parser shared by httpfs (requests) and httpc (responses)##
+
+# bytes of start line and headers a message may have, a peer sending more is not speaking HTTP
+MAX_HEAD_SIZE = 64 * 1024
+
+HEAD_END = b'\r\n\r\n'
+
+
+class HTTPMessage:
+    """
+    HTTPMessage is a request or response whose start line and headers were parsed once.
+    body is a memoryview of the bytes received so far, complete once the parser is.
+    """
+
+    def __init__(self, head, isResponse):
+        self.head = head
+        lines = head[:-len(HEAD_END)].decode().split('\r\n')
+        self.startLine = lines[0]
+        # "Name: value" as received, for printing
+        self.headerLines = lines[1:]
+        # lower-case name -> value of its first occurrence
+        self.headers = {}
+        for line in self.headerLines:
+            name, _, value = line.partition(':')
+            self.headers.setdefault(name.strip().lower(), value.strip())
+        parts = self.startLine.split(' ', 2)
+        if len(parts) < 2:
+            raise ValueError("malformed start line: " + self.startLine)
+        if isResponse:
+            # HTTP/1.1 200 OK
+            self.version, self.code, self.status = parts[0], int(parts[1]), parts[2] if len(parts) > 2 else ''
+            self.method = self.path = None
+        else:
+            # GET /path HTTP/1.1
+            self.method, self.path, self.version = parts[0], parts[1], parts[2] if len(parts) > 2 else ''
+            self.code = self.status = None
+        try:
+            self.contentLength = int(self.Header('Content-Length') or 0)
+        except ValueError:
+            raise ValueError("malformed Content-Length: " + self.Header('Content-Length'))
+        if self.contentLength < 0:
+            raise ValueError("negative Content-Length: " + self.Header('Content-Length'))
+        self.body = memoryview(b'')
+
+    def Header(self, name, default=None):
+        # header names are case-insensitive
+        return self.headers.get(name.lower(), default)
+
+    def WantsClose(self):
+        return (self.Header('Connection') or '').lower() == 'close'
+
+    def BodyText(self):
+        return str(self.body, 'utf-8')
+
+    def Text(self):
+        return self.head.decode() + self.BodyText()
+
+    def Size(self):
+        return len(self.head) + len(self.body)
+
+
+class HTTPParser:
+    """
+    HTTPParser consumes the bytes of one message in chunks as they arrive. message is set as soon as the headers
+    are complete, so the message can be answered before its body is in; the body then grows as it arrives rather
+    than by its Content-Length up front, which the peer chose, and is handed to bodySink chunk by chunk too if given,
+    e.g. to write a download to a file.
+    A message that is not HTTP, e.g. a malformed start line or Content-Length, raises ValueError.
+    """
+
+    def __init__(self, isResponse=False, bodySink=None):
+        self.isResponse = isResponse
+        self.bodySink = bodySink
+        self.head = bytearray()
+        self.message = None
+        self.bodyBuffer = None
+        self.received = 0
+
+    def HeadComplete(self):
+        return self.message is not None
+
+    def Complete(self):
+        return self.message is not None and self.received == self.message.contentLength
+
+    def Feed(self, data):
+        """
+        Feed parses the next bytes of the stream and returns how many of them belong to the message,
+        the rest is the start of the next one.
+        """
+        view = memoryview(data)
+        consumed = 0
+        if self.message is None:
+            # the end of the head may straddle the previous chunk, only the new bytes are searched
+            start = max(len(self.head) - len(HEAD_END) + 1, 0)
+            self.head += view
+            end = self.head.find(HEAD_END, start)
+            if end < 0:
+                if len(self.head) > MAX_HEAD_SIZE:
+                    raise ValueError("header section too large")
+                return len(view)
+            end += len(HEAD_END)
+            consumed = len(view) - (len(self.head) - end)
+            del self.head[end:]
+            self.message = HTTPMessage(bytes(self.head), self.isResponse)
+            self.bodyBuffer = bytearray()
+        take = min(self.message.contentLength - self.received, len(view) - consumed)
+        if take > 0:
+            piece = view[consumed:consumed + take]
+            # a bytearray cannot grow while a view of it is exported
+            self.message.body.release()
+            self.bodyBuffer += piece
+            self.received += take
+            self.message.body = memoryview(self.bodyBuffer)
+            if self.bodySink is not None:
+                self.bodySink(piece)
+            consumed += take
+        return consumed
+
+    def ReadFrom(self, reader, headOnly=False):
+        """
+        ReadFrom feeds the parser from a StreamReader until the head (headOnly) or the whole message is parsed,
+        the bytes after it stay in the reader for the next message. Returns False if the stream ends before.
+        """
+        while not (self.HeadComplete() if headOnly else self.Complete()):
+            if not reader.buffer and not reader.Fill():
+                return False
+            del reader.buffer[:self.Feed(reader.buffer)]
+        return True
@@ -0,0 +1,113 @@
+##fixed set of handler threads with a bounded queue, used by ReliableServer instead of a thread per connection##
+import threading
+import time
+from collections import deque
+
+from ReliableTransport import MAX_RTO
+
+# seconds a refused client counts as waiting for a handler: it retries its SYN at least every MAX_RTO until admitted
+REFUSED_WAITING = 2 * MAX_RTO
+
+
+class HandlerPool:
+    """
+    HandlerPool runs submitted handlers on handlers threads, in order, the ones beyond wait in a queue.
+    A connection takes a slot when it opens (Admit) and frees it when its handler returns, so at most
+    handlers + queueSize connections are admitted at once; Admit refuses the next ones and the caller applies
+    its overload policy to them. Latency under load thus grows with the queue, not with thread switches.
+    """
+
+    def __init__(self, handlers, queueSize):
+        self.handlers = handlers
+        self.queueSize = queueSize
+        # (handler, args, submitted at) waiting for a thread
+        self.queue = deque()
+        self.condition = threading.Condition()
+        # admitted connections whose handler did not return yet, queued, running or waiting for their request
+        self.admitted = 0
+        self.busy = 0
+        self.refused = 0
+        # client -> when it was last refused, until it is admitted or stops retrying
+        self.waiting = {}
+        self.completed = 0
+        # seconds the handlers waited in the queue, summed and at most
+        self.queueWait = 0.0
+        self.maxQueueWait = 0.0
+        self.started = False
+
+    def Start(self):
+        with self.condition:
+            if not self.started:
+                self.started = True
+                for i in range(self.handlers):
+                    threading.Thread(target=self.Run, daemon=True).start()
+        return self
+
+    def Admit(self, client=None):
+        """
+        Admit takes a slot for a new connection of client and returns False when the pool is full.
+        Every admitted connection has to Submit its handler, the slot is freed when it returns.
+        A refused client counts as waiting, see Contended, until it is admitted or forgotten.
+        """
+        with self.condition:
+            if self.admitted >= self.handlers + self.queueSize:
+                self.refused += 1
+                if client is not None:
+                    self.waiting[client] = time.time()
+                return False
+            self.admitted += 1
+            self.waiting.pop(client, None)
+            return True
+
+    def Forget(self, client):
+        # a refused client that was served elsewhere, e.g. shed, waits no longer
+        with self.condition:
+            self.waiting.pop(client, None)
+
+    def Withdraw(self):
+        # an admitted connection whose handler will never be submitted, e.g. its client vanished, frees its slot
+        with self.condition:
+            self.admitted -= 1
+
+    def Contended(self):
+        """
+        Contended tells whether connections wait for a handler: queued, or refused and still retrying their SYN,
+        which they may do seconds apart. A handler that only waits for its client, e.g. on a kept-alive connection,
+        should then give its thread up.
+        """
+        with self.condition:
+            expired = time.time() - REFUSED_WAITING
+            for client in [client for client, refusedAt in self.waiting.items() if refusedAt < expired]:
+                del self.waiting[client]
+            return bool(self.queue) or bool(self.waiting)
+
+    def Submit(self, handler, *args):
+        with self.condition:
+            self.queue.append((handler, args, time.time()))
+            self.condition.notify()
+
+    def Run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue)
+                handler, args, submittedAt = self.queue.popleft()
+                wait = time.time() - submittedAt
+                self.queueWait += wait
+                self.maxQueueWait = max(self.maxQueueWait, wait)
+                self.busy += 1
+            try:
+                handler(*args)
+            except Exception as e:
+                print(e)
+            finally:
+                with self.condition:
+                    self.busy -= 1
+                    self.admitted -= 1
+                    self.completed += 1
+
+    def Stats(self):
+        with self.condition:
+            return {'handlers': self.handlers, 'queueSize': self.queueSize, 'busy': self.busy,
+                    'queued': len(self.queue), 'admitted': self.admitted, 'refused': self.refused,
+                    'waiting': len(self.waiting),
+                    'completed': self.completed, 'queueWait': self.queueWait, 'maxQueueWait': self.maxQueueWait}
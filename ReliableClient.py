@@ -1,28 +1,37 @@
-##pakcet types: 0-> data, 1-> SYN, 2-> SYNACK, 3-> Ack, 4-> FIN, 5-> FINACK##
-from collections import OrderedDict
-import math
+##pakcet types: 0-> data, 1-> SYN, 2-> SYNACK, 3-> Ack, 4-> FIN, 5-> FINACK, 6-> data with piggybacked Ack##
 import threading
 import time
 import ipaddress
 
 from packet import Packet
+from ReliableTransport import (MAX_RETRIES, MAX_SEGMENT_SIZE, OPTION_FAST_OPEN, DecodeOptions, DelayedAck,
+                               FastOpenPayload, HandshakeOptions, NegotiatedSegmentSize, ReceiveWindow,
+                               ReliableConnection, SendWindow)
 import socket
 
+# seconds the reception handler blocks at a time, so that it notices a released connection without traffic
+RECEIVE_POLL = 0.5
 
-class ReliableClient:
 
-    def __init__(self, routerAddress, routerPort, peerAddress, peerPort, segmentSize, timeoutInterval=0.05):
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+class ReliableClient(ReliableConnection):
+
+    def __init__(self, routerAddress, routerPort, peerAddress, peerPort, segmentSize=None, timeoutInterval=0.5,
+                 fastOpen=False):
+        # largest segment we accept, the one actually sent with is agreed on in the handshake
+        self.maxSegmentSize = segmentSize or MAX_SEGMENT_SIZE
+        super().__init__(socket.socket(socket.AF_INET, socket.SOCK_DGRAM), (routerAddress, routerPort),
+                         ipaddress.ip_address(socket.gethostbyname(peerAddress)), peerPort, self.maxSegmentSize,
+                         timeoutInterval)
         self.routerAddress = routerAddress
         self.routerPort = routerPort
-        self.peerAddress = ipaddress.ip_address(socket.gethostbyname(peerAddress))
-        self.peerPort = peerPort
-        self.segmentSize = segmentSize
-        self.timeoutInterval = timeoutInterval
-        self.sendBase = 0
-        self.receivedData = OrderedDict()
-        self.FINACK = False
-        self.connectionTerminated = False
+        self.synRetransmitted = False
+        # fast open: Transfer sends a request that fits in the SYN with it, see FastOpenPayload
+        self.fastOpen = fastOpen
+        self.fastOpenAccepted = False
+        # packets that arrived during the handshake, before the reception handler runs
+        self.earlyPackets = []
+        # set by ReleaseSocket once both sides are closed, the reception handler then closes the socket
+        self.releasedAt = None
 
     def ConnectionSetTimeout(self, timeout):
         self.connection.settimeout(timeout)
@@ -30,159 +39,204 @@ class ReliableClient:
     def CancellConnectionTimeout(self):
         self.connection.settimeout(None)
 
-    def SingleSend(self, packetType, seq_num, data):
-        p = Packet(packet_type=packetType,
-                   seq_num=seq_num,
-                   peer_ip_addr=self.peerAddress,
-                   peer_port=self.peerPort,
-                   payload=data)
-        try:
-            self.connection.sendto(p.to_bytes(), (self.routerAddress, self.routerPort))
-            # print('sent type:', p.packet_type)
-        except Exception as e:
-            print(e)
-
     def SingleReceive(self):
         response, sender = self.connection.recvfrom(1024)
+        self.stats.Received(len(response))
         p = Packet.from_bytes(response)
         return p
 
-    def Handshake(self):
+    def Handshake(self, synPayload):
         try:
             print("sending SYN...")
-            self.ConnectionSetTimeout(0.5)
-            self.SingleSend(1, 0, ''.encode())
+            self.ConnectionSetTimeout(self.rttEstimator.Timeout())
+            synSentAt = time.time()
+            self.SingleSend(1, 0, synPayload)
 
             print("waiting for SYNACK...")
             response = self.SingleReceive()
+            while response.packet_type != 2:
+                # the FIN with a fast open response can overtake the SYNACK, it is handled once the connection is up
+                self.earlyPackets.append(response)
+                self.ConnectionSetTimeout(max(synSentAt + self.rttEstimator.Timeout() - time.time(), 0.0001))
+                response = self.SingleReceive()
             self.CancellConnectionTimeout()
 
-            if response.packet_type == 2:
-                print('SYNACK received! Sending SYNACK ...')
-                self.SingleSend(2, 0, ''.encode())
-                return True
-            else:
-                return False
+            # Karn's rule: a SYNACK may answer any of the retransmitted SYNs, so only time the first one
+            if not self.synRetransmitted:
+                self.rttEstimator.AddSample(time.time() - synSentAt)
+            self.segmentSize = NegotiatedSegmentSize(self.maxSegmentSize, response.payload)
+            self.fastOpenAccepted = OPTION_FAST_OPEN in DecodeOptions(response.payload)
+            print('SYNACK received! Sending SYNACK ...')
+            self.SingleSend(2, 0, ''.encode())
+            return True
 
         except socket.timeout:
+            self.synRetransmitted = True
+            self.rttEstimator.Backoff()
             return False
 
-    # segmentation
-    def Segment(self, data):
-        dataBytes = data.encode()
-        segments = OrderedDict()
-
-        if len(dataBytes) < self.segmentSize:
-            segments[0] = dataBytes
-        else:
-            nofSegments = math.ceil(len(dataBytes) / self.segmentSize)
-
-            for i in range(nofSegments):
-                firstIndex = self.segmentSize * i
-                lastIndex = firstIndex + self.segmentSize - 1
-                # +1 after lastIndex is to include up to the lastIndex th item
-                segments[i] = dataBytes[firstIndex:lastIndex + 1]
-
-        return segments, nofSegments
-
     def InitializeConnectionVariables(self):
         self.sendBase = 0
-        self.receivedData.clear()
-        self.connectionTerminated = False
+        self.receiveWindow = ReceiveWindow()
+        self.delayedAck = DelayedAck()
+        self.peerClosed = False
         self.FINACK = False
 
     def RetrieveReceivedData(self):
-        # wait for connection termination
-        while not self.connectionTerminated:
-            time.sleep(self.timeoutInterval)
-            pass
-
-        self.receivedData = OrderedDict(sorted(self.receivedData.items()))
-        receivedData = b''.join(self.receivedData.values())
-        print('received data is: ', receivedData.decode())
-        return receivedData.decode()
+        # wait for connection termination, the reception handler notifies as soon as the FIN arrives
+        receivedData = b''.join(self.ReceiveStream()).decode()
+        print('received data is: ', receivedData)
+        return receivedData
 
     def TerminateConnection(self):
-        while not self.FINACK:
-            # send FIN
-            self.SingleSend(4, self.sendBase, ''.encode())
-            time.sleep(self.timeoutInterval)
-
-    def Transfer(self, data):
-        segmentsPayload, nofSegments = self.Segment(data)
-
-        successfulHandshake = False
-        while not successfulHandshake:
-            successfulHandshake = self.Handshake()
-            if successfulHandshake:
+        if self.FINACK:
+            # our side is already closed, the SYNACK of a fast open request counts as its FINACK
+            return
+        self.stats.TeardownStarted()
+        with self.stateCondition:
+            for attempt in range(MAX_RETRIES + 1):
+                # send FIN, it carries our cumulative ACK number like any ACK
+                self.delayedAck.Sent()
+                self.SingleSend(4, self.GetAckNumber(), ''.encode())
+                deadline = time.time() + self.rttEstimator.Timeout()
+                while not self.FINACK and time.time() < deadline:
+                    self.WaitUntil(deadline)
+                if self.FINACK:
+                    self.stats.Closed()
+                    return
+                self.rttEstimator.Backoff()
+            # the server is gone, do not wait for its FIN either
+            self.peerClosed = True
+            self.stateCondition.notify_all()
+            self.stats.Closed()
+
+    def Close(self):
+        """
+        Close ends a kept-alive connection: sends FIN and waits for the server's FIN, so that it gets its FINACK.
+        Data still arriving in between is discarded.
+        """
+        self.TerminateConnection()
+        for chunk in self.ReceiveStream():
+            pass
+        print("TIME WAIT state")
+        self.ReleaseSocket()
+
+    def ReleaseSocket(self):
+        """
+        ReleaseSocket ends the client: the reception handler stops and closes the socket once the server has been
+        quiet for two timeouts (TIME WAIT), so that a retransmitted FIN still gets its FINACK.
+        """
+        self.releasedAt = time.time()
+
+    def Connect(self, request=None):
+        """
+        Connect opens the connection. request, bytes that are the whole data of our side, is sent with the SYN
+        if it fits (fast open); fastOpenAccepted then tells whether the server took it, otherwise it still has to
+        be sent. Raises ConnectionError when the server does not answer MAX_RETRIES retransmitted SYNs.
+        """
+        synPayload = FastOpenPayload(self.maxSegmentSize, request) if request is not None else None
+        if synPayload is None:
+            synPayload = HandshakeOptions(self.maxSegmentSize)
+        self.synRetransmitted = False
+        self.fastOpenAccepted = False
+        self.earlyPackets = []
+        self.stats.HandshakeStarted()
+        for attempt in range(MAX_RETRIES + 1):
+            if self.Handshake(synPayload):
                 print("Successful handshake!")
-            else:
-                print("Unsuccessful handshake")
+                break
+            print("Unsuccessful handshake")
+        else:
+            # the reception handler never ran, nothing else closes the socket
+            self.connection.close()
+            raise ConnectionError("no SYNACK from {}:{}".format(self.peerAddress, self.peerPort))
 
+        # the SYN backoff only reflects the handshake losses, data starts from the unbacked-off timeout
+        self.rttEstimator.ResetBackoff()
         self.InitializeConnectionVariables()
-        threading.Thread(target=self.ReceptionHandler, args=(self.connection,)).start()
-        # send upon the reception of the data from application layer
-        for i in range(nofSegments):
-            self.SingleSend(0, i, segmentsPayload[i])
-
-        # resend unacknowledged packets
-        time.sleep(self.timeoutInterval)
-        while self.sendBase < nofSegments:
-            self.SingleSend(0, self.sendBase, segmentsPayload[self.sendBase])
-            time.sleep(self.timeoutInterval)
+        self.sendWindow = SendWindow(self.segmentSize, self.rttEstimator, self.congestionWindow)
+        self.stats.Established()
+        if self.fastOpenAccepted:
+            # the request was delivered with the SYN and our side is closed with it
+            self.stats.TeardownStarted()
+            self.FINACK = True
+            self.stats.Closed()
+        # daemon, so that the process can exit once the connection is closed
+        threading.Thread(target=self.ReceptionHandler, args=(self.connection,), daemon=True).start()
+
+    def PeerStopsReading(self):
+        # the server's FIN ends the exchange, e.g. an idle kept-alive connection it closed while our request was on
+        # its way
+        return self.peerClosed
+
+    def SendRequest(self, data):
+        """
+        SendRequest connects, sends data and closes our side of the connection, the response is then read
+        with ReceiveStream or RetrieveReceivedData. With fastOpen a small request goes out with the SYN.
+        """
+        request = None
+        if self.fastOpen and isinstance(data, (str, bytes, bytearray)):
+            request = data.encode() if isinstance(data, str) else bytes(data)
+        self.Connect(request)
+        if not self.fastOpenAccepted:
+            # send upon the reception of the data from application layer
+            self.Send(data)
 
         # connection termination by sending FIN
         print("Sent request to the server. Sending FIN...")
         self.TerminateConnection()
 
-        receivedData = self.RetrieveReceivedData()
-        print("TIME WAIT state")
+    def Transfer(self, data):
+        try:
+            self.SendRequest(data)
+            receivedData = self.RetrieveReceivedData()
+            print("TIME WAIT state")
+        finally:
+            self.ReleaseSocket()
         return receivedData
 
-    def GetAckNumber(self):
-        orderedData = OrderedDict(sorted(self.receivedData.items()))
-        expected = 0
-        for i in range(len(orderedData)):
-            if i in orderedData:
-                expected += 1
-            else:
-                break
-        return expected
-
-    def SendAck(self):
-        expected = self.GetAckNumber()
-        self.SingleSend(3, expected, ''.encode())
-
     def ReceptionHandler(self, connection):
-        while True:
+        for packet in self.earlyPackets:
+            self.HandlePacket(packet)
+        self.earlyPackets = []
+        connection.settimeout(RECEIVE_POLL)
+        heardAt = time.time()
+        while self.releasedAt is None or time.time() - max(heardAt, self.releasedAt) < 2 * self.rttEstimator.Timeout():
             try:
                 response, sender = connection.recvfrom(1024)
-                packet = Packet.from_bytes(response)
-                # print('received type:', packet.packet_type)
-
-                # ACK
-                if packet.packet_type == 3:
-                    if packet.seq_num > self.sendBase:
-                        self.sendBase = packet.seq_num
-
-                # data
-                elif packet.packet_type == 0:
-                    self.receivedData[packet.seq_num] = packet.payload
-                    self.SendAck()
-
-                # FIN
-                elif packet.packet_type == 4:
-                    self.connectionTerminated = True
-                    # send FINACK
-                    self.SingleSend(5, self.GetAckNumber(), ''.encode())
-
-                # FINACK
-                elif packet.packet_type == 5:
-                    print('Received FINACK! -> FIN wait 2 state')
-                    self.FINACK = True
-
+            except socket.timeout:
+                continue
+            except OSError as e:
+                # the socket is gone, nothing more can arrive
+                print(e)
+                break
+            heardAt = time.time()
+            try:
+                self.stats.Received(len(response))
+                self.HandlePacket(Packet.from_bytes(response))
             except Exception as e:
                 print(e)
+        connection.close()
+
+    def HandlePacket(self, packet):
+        # print('received type:', packet.packet_type)
+        # FIN
+        if packet.packet_type == 4:
+            with self.stateCondition:
+                # a FIN with payload carries the whole response of a fast open connection
+                if packet.payload:
+                    self.receiveWindow.Insert(0, packet.payload)
+                # the FIN acknowledges our data too, in case the server's last ACK got lost
+                self.sendWindow.Acknowledge(packet.seq_num, b'', time.time(), pure=False)
+                # send FINACK before the application is woken up, a process that exits right after loses it
+                self.SingleSend(5, self.GetAckNumber(), ''.encode())
+                self.peerClosed = True
+                self.stateCondition.notify_all()
+
+        else:
+            if packet.packet_type == 5:
+                print('Received FINACK! -> FIN wait 2 state')
+            super().HandlePacket(packet)
 
 
 # reliclinet = ReliableClient('localhost', 3000, 'localhost', 8007, 3)
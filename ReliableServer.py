@@ -1,159 +1,375 @@
-##pakcet types: 0-> data, 1-> SYN, 2-> SYNACK, 3-> Ack, 4-> FIN, 5-> FINACK##
+##pakcet types: 0-> data, 1-> SYN, 2-> SYNACK, 3-> Ack, 4-> FIN, 5-> FINACK, 6-> data with piggybacked Ack##
 import socket
 import time
 from collections import OrderedDict
 from packet import Packet
-import ipaddress
-import math
+from ReliableTransport import (MAX_RETRIES, MAX_RTO, MAX_SEGMENT_SIZE, OPTION_FAST_OPEN, AddStats, HandshakeOptions,
+                               NegotiatedSegmentSize, ReliableConnection, SegmentedPayload, SendWindow, SplitOptions)
+from HandlerPool import HandlerPool
 import threading
 
+# handler threads and connections waiting for one, beyond them the overload policy applies, see ReliableServer.Admit
+HANDLERS = 32
+HANDLER_QUEUE = 64
+# threads answering the shed connections, their responses are short
+SHED_HANDLERS = 4
+# seconds the SYN of a finished fast open connection is remembered, a late duplicate of it must not run its request again
+FAST_OPEN_MEMORY = 60.0
+# seconds without a packet after which a client that still owes its handshake or request is considered gone,
+# a live one retransmits at least every MAX_RTO
+CLIENT_IDLE = 2 * MAX_RTO
+
 
 class ReliableServer:
-    def __init__(self, serverport, segmentSize, timeoutInterval=0.05):
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.sender = None
+    def __init__(self, serverport, segmentSize=None, timeoutInterval=0.5, fastOpen=False, handlers=HANDLERS,
+                 queueSize=HANDLER_QUEUE, overload='refuse', connection=None):
+        # a connection handed in is bound already, e.g. the SteeredSocket of one worker of a ShardedServer
+        self.bound = connection is not None
+        self.connection = connection or socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.serverPort = serverport
-        self.peerAddress = ''
-        self.peerPort = 0
-        self.segmentSize = segmentSize
+        # largest segment accepted, each connection sends with the smaller of it and the client's MSS
+        self.segmentSize = segmentSize or MAX_SEGMENT_SIZE
+        # initial retransmission timeout of every connection
         self.timeoutInterval = timeoutInterval
-        self.sendBase = 0
-        self.receivedData = OrderedDict()
-        self.peerTerminatedConnection = False
-        self.FINACK = False
+        # accept requests sent with the SYN, see FastOpenPayload
+        self.fastOpen = fastOpen
+        # (peer_ip_addr, peer_port) -> ServerConnection
+        self.connections = {}
+        self.connectionsLock = threading.Lock()
+        self.streaming = False
+        # the handlers run on a fixed pool instead of a thread per connection
+        self.pool = HandlerPool(handlers, queueSize)
+        # 'refuse' or 'shed', what happens to new connections while the pool is full
+        self.overload = overload
+        self.shedPool = HandlerPool(SHED_HANDLERS, queueSize) if overload == 'shed' else None
+        self.overloadHandler = None
+        # (peer, SYN payload) -> removal time of the fast open connections removed in the last FAST_OPEN_MEMORY seconds
+        self.fastOpened = OrderedDict()
+        # counters summed over the connections already removed, see GetStats
+        self.closedStats = {}
+        self.closedConnections = 0
 
-    def RunServer(self, serverHandler):
+    def RunServer(self, serverHandler, streaming=False, overloadHandler=None):
+        """
+        RunServer calls serverHandler(data, serverConnection) on a thread of the handler pool for every connection.
+        By default data is the whole request as str, handed over once the client's FIN arrives.
+        With streaming the handler starts as soon as the connection opens and data is the generator
+        ServerConnection.ReceiveStream, which yields the request bytes in order while they arrive.
+        overloadHandler, called the same way, answers the connections shed while the pool is full.
+        """
+        self.streaming = streaming
+        self.overloadHandler = overloadHandler
+        self.pool.Start()
+        if self.shedPool is not None:
+            self.shedPool.Start()
         try:
-            self.connection.bind(('', self.serverPort))
-            print("Server is listening at port: ", self.serverPort)
+            if not self.bound:
+                self.connection.bind(('', self.serverPort))
+                print("Server is listening at port: ", self.serverPort)
             threading.Thread(target=self.ReceptionHandler, args=(self.connection, serverHandler)).start()
         except Exception as e:
             print(e)
 
-    # segmentation
-    def Segment(self, data):
-        dataBytes = data.encode()
-        segments = OrderedDict()
+    def RemoveConnection(self, serverConnection):
+        with self.connectionsLock:
+            key = (serverConnection.peerAddress, serverConnection.peerPort)
+            if self.connections.get(key) is serverConnection:
+                del self.connections[key]
+                AddStats(self.closedStats, serverConnection.GetStats())
+                self.closedConnections += 1
+                if serverConnection.fastOpenSyn is not None:
+                    self.fastOpened[(key, serverConnection.fastOpenSyn)] = time.time()
 
-        if len(dataBytes) < self.segmentSize:
-            segments[0] = dataBytes
-        else:
-            nofSegments = math.ceil(len(dataBytes) / self.segmentSize)
+    def IsFastOpenReplay(self, key, synPayload):
+        """
+        IsFastOpenReplay tells whether a SYN looks like the one that opened a fast open connection of the peer
+        that is already gone. It may be a delayed or duplicated copy, whose request, e.g. a POST, was served once,
+        or a new client on a reused port sending the same request. Callers hold connectionsLock.
+        """
+        expired = time.time() - FAST_OPEN_MEMORY
+        while self.fastOpened and next(iter(self.fastOpened.values())) < expired:
+            self.fastOpened.popitem(last=False)
+        return (key, bytes(synPayload)) in self.fastOpened
 
-            for i in range(nofSegments):
-                firstIndex = self.segmentSize * i
-                lastIndex = firstIndex + self.segmentSize - 1
-                # +1 after lastIndex is to include up to the lastIndex th item
-                segments[i] = dataBytes[firstIndex:lastIndex + 1]
+    def GetStats(self):
+        """
+        GetStats returns the stats of every open connection and the counters summed over all connections,
+        the closed ones included.
+        """
+        with self.connectionsLock:
+            connections = list(self.connections.values())
+            totals = dict(self.closedStats)
+            closedConnections = self.closedConnections
+        snapshots = [serverConnection.GetStats() for serverConnection in connections]
+        for snapshot in snapshots:
+            AddStats(totals, snapshot)
+        stats = {'openConnections': len(snapshots), 'closedConnections': closedConnections, 'totals': totals,
+                 'handlers': self.pool.Stats(), 'connections': snapshots}
+        if self.shedPool is not None:
+            stats['shedHandlers'] = self.shedPool.Stats()
+        return stats
 
-        return segments, nofSegments
+    def Admit(self, serverHandler, key):
+        """
+        Admit returns the pool and handler of a new connection, or (None, None) to leave its SYN unanswered.
+        While every handler is busy and the queue is full, overload 'shed' hands the connection to overloadHandler,
+        e.g. a 503, on a few threads of their own; 'refuse', or a full shedding pool, stops SYNACKing instead,
+        so the client backs off and retries. Callers hold connectionsLock.
+        """
+        if self.pool.Admit(key):
+            return self.pool, serverHandler
+        if self.shedPool is not None and self.overloadHandler is not None and self.shedPool.Admit():
+            self.pool.Forget(key)
+            return self.shedPool, self.overloadHandler
+        return None, None
 
-    def InitializeConnectionVariables(self):
-        self.sendBase = 0
-        self.receivedData.clear()
-        self.peerTerminatedConnection = False
-        self.FINACK = False
+    def ReceptionHandler(self, connection, serverHandler):
+        while True:
+            try:
+                response, sender = connection.recvfrom(1024)
+                packet = Packet.from_bytes(response)
+                key = (packet.peer_ip_addr, packet.peer_port)
+                # print('received type:', packet.packet_type)
 
-    def TerminateConnection(self):
-        while not self.FINACK:
-            self.SingleSend(4, self.sendBase, ''.encode())
-            time.sleep(self.timeoutInterval)
+                with self.connectionsLock:
+                    serverConnection = self.connections.get(key)
+                    # SYN from a new peer opens a new connection, a repeated one is handled by its connection
+                    if serverConnection is None and packet.packet_type == 1:
+                        pool, handler = self.Admit(serverHandler, key)
+                        if pool is not None:
+                            serverConnection = ServerConnection(self, packet.peer_ip_addr, packet.peer_port, sender,
+                                                                pool, handler)
+                            # a possible replay gets a plain handshake: a new client then sends its request again,
+                            # a stale copy has no client behind it and its connection expires after CLIENT_IDLE
+                            serverConnection.fastOpenRefused = self.IsFastOpenReplay(key, packet.payload)
+                            self.connections[key] = serverConnection
+                            if self.streaming:
+                                pool.Submit(handler, serverConnection.ReceiveStream(), serverConnection)
 
-    def Transfer(self, data):
-        segmentsPayload, nofSegments = self.Segment(data)
+                if serverConnection is not None:
+                    serverConnection.lastHeard = time.time()
+                    serverConnection.stats.Received(len(response))
+                    serverConnection.HandlePacket(packet)
 
-        print("Sending response to the client...")
+                # a refused SYN falls through unanswered, the client retries it
+                # FIN of a connection that is already closed, its FINACK got lost
+                elif packet.packet_type == 4:
+                    p = Packet(packet_type=5,
+                               seq_num=packet.seq_num,
+                               peer_ip_addr=packet.peer_ip_addr,
+                               peer_port=packet.peer_port,
+                               payload=''.encode())
+                    connection.sendto(p.to_bytes(), sender)
 
-        # send response to the client
-        for i in range(nofSegments):
-            self.SingleSend(0, i, segmentsPayload[i])
+            except Exception as e:
+                print(e)
 
-        # resend unacknowledged packets
-        time.sleep(self.timeoutInterval)
-        while self.sendBase < nofSegments:
-            self.SingleSend(0, self.sendBase, segmentsPayload[self.sendBase])
-            time.sleep(self.timeoutInterval)
 
-        # connection termination by sending FIN
-        self.TerminateConnection()
-        print("Sent Response to the client!")
+class ServerConnection(ReliableConnection):
+    """
+    ServerConnection is the state of one peer of a ReliableServer: its own buffers, windows and timers.
+    """
 
-    def RetrieveReceivedData(self):
-        self.receivedData = OrderedDict(sorted(self.receivedData.items()))
-        receivedData = b''.join(self.receivedData.values())
-        return receivedData.decode()
-
-    def SingleSend(self, packetType, seq_num, data):
-        p = Packet(packet_type=packetType,
-                   seq_num=seq_num,
-                   peer_ip_addr=self.peerAddress,
-                   peer_port=self.peerPort,
-                   payload=data)
-        self.connection.sendto(p.to_bytes(), self.sender)
-        # print('sent type:', p.packet_type)
-
-    def GetAckNumber(self):
-        orderedData = OrderedDict(sorted(self.receivedData.items()))
-        expected = 0
-        for i in range(len(orderedData)):
-            if i in orderedData:
-                expected += 1
-            else:
-                break
-        return expected
-
-    def SendAck(self):
-        expected = self.GetAckNumber()
-        self.SingleSend(3, expected, ''.encode())
+    def __init__(self, server, peerAddress, peerPort, sender, pool, handler):
+        # replies go to where the client's packets came from, the router
+        super().__init__(server.connection, sender, peerAddress, peerPort, server.segmentSize, server.timeoutInterval)
+        self.server = server
+        # where the handler of the connection runs, and which one: the server's or, when shed, its overloadHandler
+        self.pool = pool
+        self.handler = handler
+        self.synCount = 0
+        self.synAckSentAt = None
+        self.sendWindow = SendWindow(self.segmentSize, self.rttEstimator, self.congestionWindow)
+        # the client's request came with its SYN
+        self.fastOpen = False
+        # response of a fast open connection that goes out with our FIN instead of data segments
+        self.finPayload = None
+        # the SYN that carried the request, remembered by the server once the connection is gone
+        self.fastOpenSyn = None
+        # the SYN matches a remembered one, its request is not taken, see ReliableServer.IsFastOpenReplay
+        self.fastOpenRefused = False
+        # the client stopped answering, it gets no FIN
+        self.clientGone = False
+        # last packet from the client, the idle timer expires the connection CLIENT_IDLE seconds after it
+        self.lastHeard = time.time()
+        self.timers.Schedule(self.lastHeard + CLIENT_IDLE, self.OnIdleTimer)
 
-    def ReceptionHandler(self, connection, serverHandler):
-        while True:
+    def TerminateConnection(self):
+        self.stats.TeardownStarted()
+        with self.stateCondition:
+            # a client that already left can not answer, give up after MAX_RETRIES
+            for attempt in range(MAX_RETRIES + 1):
+                # the FIN carries our cumulative ACK number like any ACK
+                self.delayedAck.Sent()
+                sentAt = time.time()
+                self.SingleSend(4, self.GetAckNumber(), self.finPayload or b'')
+                # the timeout is looked at again on every notification: the FIN of a fast open connection
+                # goes out before the first RTT sample, which the SYNACK echo brings a moment later
+                while not self.FINACK and not self.clientGone and time.time() < sentAt + self.rttEstimator.Timeout():
+                    self.WaitUntil(sentAt + self.rttEstimator.Timeout())
+                if self.FINACK or self.clientGone:
+                    break
+                self.rttEstimator.Backoff()
+        self.stats.Closed()
+
+    def Close(self):
+        """
+        Close sends FIN once everything sent is acknowledged and forgets the connection.
+        """
+        if not self.clientGone:
+            self.TerminateConnection()
+        self.server.RemoveConnection(self)
+
+    def OnIdleTimer(self):
+        # runs on the wheel thread, re-armed from the last packet instead of on every packet
+        if self.stats.State() == 'closed':
+            return
+        idleUntil = self.lastHeard + CLIENT_IDLE
+        if time.time() < idleUntil:
+            self.timers.Schedule(idleUntil, self.OnIdleTimer)
+        elif not self.Expire():
+            # the client waits for the response, silent as well, look again later
+            self.timers.Schedule(time.time() + CLIENT_IDLE, self.OnIdleTimer)
+
+    def Expire(self):
+        """
+        Expire gives up on a client that fell silent while the connection waits for it: before or in the middle of
+        its request, or for the FINACK. Its handler sees the end of the request and closes without a FIN;
+        one that was not submitted yet never will be, its slot and the connection are freed here.
+        A client whose request is complete waits for the response, that is up to the handler: returns False then.
+        """
+        with self.stateCondition:
+            if self.peerClosed and self.stats.State() != 'closing':
+                return False
+            # a non-streaming handler is submitted once the request is complete
+            unsubmitted = not self.peerClosed and not self.server.streaming
+            self.clientGone = True
+            self.peerClosed = True
+            self.stateCondition.notify_all()
+        print("Client went silent, connection expired")
+        if unsubmitted:
+            self.pool.Withdraw()
+            self.Abandon()
+        return True
+
+    def PeerStopsReading(self):
+        return self.clientGone
+
+    def Abandon(self):
+        # the client is gone: forget the connection right away, its handler ends with the error and frees its slot
+        self.clientGone = True
+        self.stats.Closed()
+        self.server.RemoveConnection(self)
+
+    def Send(self, data):
+        """
+        Send streams data to the client like ReliableConnection.Send, the first response of a fast open connection
+        may go out with the FIN instead. Raises ConnectionError when the client stopped answering.
+        """
+        with self.stateCondition:
+            if self.DeferToFin(data):
+                return
+            if self.finPayload is not None:
+                # more is sent after all, the deferred response goes first as ordinary data
+                self.sendWindow.Append(self.finPayload)
+                self.finPayload = None
             try:
-                response, self.sender = connection.recvfrom(1024)
-                packet = Packet.from_bytes(response)
-                self.peerPort = packet.peer_port
-                self.peerAddress = packet.peer_ip_addr
-                # print('received type:', packet.packet_type)
+                super().Send(data)
+            except ConnectionError:
+                self.Abandon()
+                raise
+
+    def DeferToFin(self, data):
+        """
+        DeferToFin keeps the first response of a fast open connection for the FIN if it fits in one segment:
+        the client has nothing more to send, so the FIN follows right away. Callers hold stateCondition.
+        """
+        if not self.fastOpen or self.finPayload is not None or self.sendWindow.nextSeq or self.sendWindow.sources:
+            return False
+        if isinstance(data, SegmentedPayload):
+            data = data.data
+        elif isinstance(data, str):
+            data = data.encode()
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
+            return False
+        if not 0 < len(data) <= self.segmentSize:
+            return False
+        self.finPayload = bytes(data)
+        return True
+
+    def Transfer(self, data):
+        print("Sending response to the client...")
 
-                # ACK
-                if packet.packet_type == 3:
-                    if packet.seq_num > self.sendBase:
-                        self.sendBase = packet.seq_num
+        # send response to the client
+        self.Send(data)
 
-                # data
-                elif packet.packet_type == 0:
-                    self.receivedData[packet.seq_num] = packet.payload
-                    self.SendAck()
+        # connection termination by sending FIN
+        self.Close()
+        print("Sent Response to the client!")
 
-                # FIN
-                elif packet.packet_type == 4:
-                    # send FINACK
-                    self.SingleSend(5, self.GetAckNumber(), ''.encode())
+    def RetrieveReceivedData(self):
+        # the receive window already holds the data in order
+        with self.stateCondition:
+            return self.receiveWindow.Take().decode()
 
-                    # do it only on first FIN reception
-                    if not self.peerTerminatedConnection:
-                        print("Client data received!")
-                        threading.Thread(target=serverHandler, args=(self.RetrieveReceivedData(), self)).start()
-                    self.peerTerminatedConnection = True
+    def PeerTerminated(self):
+        # the client's data is complete, a non-streaming handler starts only now
+        with self.stateCondition:
+            first = not self.peerClosed
+            self.peerClosed = True
+            self.stateCondition.notify_all()
+        if first:
+            print("Client data received!")
+            if not self.server.streaming:
+                self.pool.Submit(self.handler, self.RetrieveReceivedData(), self)
 
+    def HandlePacket(self, packet):
+        # FIN
+        if packet.packet_type == 4:
+            # send FINACK
+            self.SingleSend(5, self.GetAckNumber(), ''.encode())
+            with self.stateCondition:
+                # the FIN acknowledges our data too, in case the client's last ACK got lost
+                self.sendWindow.Acknowledge(packet.seq_num, b'', time.time(), pure=False)
+            self.PeerTerminated()
 
-                # SYN
-                elif packet.packet_type == 1:
-                    self.InitializeConnectionVariables()
-                    print('SYN received! Sending SYNACK ...')
-                    self.SingleSend(2, 0, ''.encode())
+        # SYN
+        elif packet.packet_type == 1:
+            self.synCount += 1
+            print('SYN received! Sending SYNACK ...')
+            self.segmentSize = NegotiatedSegmentSize(self.server.segmentSize, packet.payload)
+            self.sendWindow.segmentSize = self.segmentSize
+            options, request = SplitOptions(packet.payload)
+            if self.server.fastOpen and request is not None and OPTION_FAST_OPEN in options and self.synCount == 1 \
+                    and not self.fastOpenRefused:
+                # fast open: the SYN carries the whole request, as if its data and FIN had arrived
+                self.fastOpen = True
+                self.fastOpenSyn = bytes(packet.payload)
+                self.stats.Established()
+                with self.stateCondition:
+                    self.receiveWindow.Insert(0, request)
+                self.PeerTerminated()
+            # a repeated SYN is answered the same way, its request was taken with the first one
+            self.SingleSend(2, 0, HandshakeOptions(self.server.segmentSize, self.fastOpen))
+            # Karn's rule: when the SYN is repeated the echoed SYNACK can not be timed
+            self.synAckSentAt = time.time() if self.synCount == 1 else None
 
-                # FINACK
-                elif packet.packet_type == 5:
-                    self.FINACK = True
+        # SYNACK echo, completes the handshake
+        elif packet.packet_type == 2:
+            self.stats.Established()
+            if self.synAckSentAt is not None:
+                with self.stateCondition:
+                    self.rttEstimator.AddSample(time.time() - self.synAckSentAt)
+                    self.stateCondition.notify_all()
+                self.synAckSentAt = None
 
-            except Exception as e:
-                print(e)
+        else:
+            super().HandlePacket(packet)
 
 
-# def ServerHandler(data, socketInstance):
+# def ServerHandler(data, serverConnection):
 #     print('received data is: ', data)
-#     socketInstance.Transfer('Hi mohamed! This is the Server.')
+#     serverConnection.Transfer('Hi mohamed! This is the Server.')
 #
 #
 # reliserver = ReliableServer(8007, 3)
@@ -0,0 +1,1026 @@
+##selective-repeat machinery shared by ReliableClient and ReliableServer##
+import heapq
+import io
+import threading
+import time
+from collections import deque
+
+from packet import MAX_LEN, MIN_LEN, SEQ_NUM, HeaderTemplate, Packet
+from TimerWheel import SharedTimerWheel
+
+# bounds of the retransmission timeout in seconds
+MIN_RTO = 0.02
+MAX_RTO = 8.0
+
+# congestion window bounds in segments, MAX_WINDOW is also the selective-repeat window
+INITIAL_WINDOW = 4
+MAX_WINDOW = 1024
+
+# largest payload that fits in one packet next to a piggybacked ACK number, the MSS offered when none is configured
+MAX_SEGMENT_SIZE = MAX_LEN - MIN_LEN - SEQ_NUM.size
+
+# the receiver ACKs every ACK_EVERY in-order segments, or ACK_DELAY seconds after the first one it holds back;
+# ACK_DELAY stays well below MIN_RTO so that a held back ACK never expires the sender's timer
+ACK_EVERY = 2
+ACK_DELAY = 0.005
+
+# SYN and FIN retransmissions before the peer is considered gone
+MAX_RETRIES = 10
+
+# duplicate ACKs, or segments SACKed above a hole, after which the hole is retransmitted without waiting for its timer
+DUPLICATE_ACK_THRESHOLD = 3
+
+# window kept on a loss repaired by fast retransmit
+FAST_RECOVERY_DECREASE = 0.7
+
+# per RTT sample decay of the maximum RTT that bounds the reordering window
+MAX_RTT_DECAY = 0.9995
+
+# kinds of the handshake options, carried as type-length-value entries in the SYN/SYNACK payload;
+# OPTION_END has no length and ends the options, the rest of the payload is fast open data
+OPTION_END = 0
+OPTION_MSS = 2
+OPTION_FAST_OPEN = 3
+
+# counters of ConnectionStats.Snapshot that add up over connections, see AddStats
+SUMMED_STATS = ('packetsSent', 'bytesSent', 'packetsReceived', 'bytesReceived', 'segmentsSent', 'retransmissions',
+                'fastRetransmissions', 'duplicateAcks', 'acksSent', 'piggybackedAcks', 'outOfOrder', 'duplicateSegments',
+                'outOfWindow', 'rttSamples')
+
+
+def DecodeSack(ackNumber, payload):
+    """
+    DecodeSack returns the sequence numbers reported as received in a SACK bitmap,
+    see ReceiveWindow.SackPayload for its layout.
+    """
+    bitmap = int.from_bytes(payload, byteorder='little')
+    sacked = []
+    seq = ackNumber + 1
+    while bitmap:
+        if bitmap & 1:
+            sacked.append(seq)
+        bitmap >>= 1
+        seq += 1
+    return sacked
+
+
+def SplitPiggybackedAck(payload):
+    """
+    SplitPiggybackedAck returns the ACK number and the data of a type 6 packet, whose payload is the sender's
+    cumulative ACK number (4 bytes, big-endian) followed by the segment's data.
+    """
+    return SEQ_NUM.unpack_from(payload)[0], payload[SEQ_NUM.size:]
+
+
+def EncodeOptions(options):
+    """
+    EncodeOptions packs {kind: value bytes} as kind (1 byte), length (1 byte), value entries.
+    """
+    payload = bytearray()
+    for kind, value in options.items():
+        payload += bytes((kind, len(value))) + value
+    return bytes(payload)
+
+
+def SplitOptions(payload):
+    """
+    SplitOptions returns {kind: value bytes} of a handshake payload and the data after OPTION_END, None without it.
+    A truncated last entry is ignored. Unknown kinds are returned too, so older peers simply skip what they
+    do not understand.
+    """
+    options = {}
+    offset = 0
+    while offset < len(payload):
+        if payload[offset] == OPTION_END:
+            return options, bytes(payload[offset + 1:])
+        if offset + 2 > len(payload):
+            break
+        kind, length = payload[offset], payload[offset + 1]
+        end = offset + 2 + length
+        if end > len(payload):
+            break
+        options[kind] = bytes(payload[offset + 2:end])
+        offset = end
+    return options, None
+
+
+def DecodeOptions(payload):
+    return SplitOptions(payload)[0]
+
+
+def HandshakeOptions(segmentSize, fastOpen=False):
+    """
+    HandshakeOptions is the SYN/SYNACK payload advertising the largest segment this side accepts.
+    In a SYNACK, fastOpen confirms that the request carried by the SYN was accepted.
+    """
+    options = {OPTION_MSS: segmentSize.to_bytes(2, byteorder='big')}
+    if fastOpen:
+        options[OPTION_FAST_OPEN] = b''
+    return EncodeOptions(options)
+
+
+def FastOpenPayload(segmentSize, data):
+    """
+    FastOpenPayload is the payload of a SYN carrying the whole request data (fast open), or None if it does not fit.
+    The server either confirms it with OPTION_FAST_OPEN in the SYNACK, which then also stands for the FINACK
+    of the client's side, or ignores the data and the client sends it the usual way.
+    """
+    payload = EncodeOptions({OPTION_MSS: segmentSize.to_bytes(2, byteorder='big'), OPTION_FAST_OPEN: b''})
+    payload += bytes((OPTION_END,)) + data
+    return payload if MIN_LEN + len(payload) <= MAX_LEN else None
+
+
+def NegotiatedSegmentSize(segmentSize, payload):
+    """
+    NegotiatedSegmentSize is the segment size to send with: the smaller of ours and the MSS the peer advertised
+    in the handshake payload. A peer without the option keeps ours.
+    """
+    mss = DecodeOptions(payload).get(OPTION_MSS)
+    if not mss:
+        return segmentSize
+    return max(min(segmentSize, int.from_bytes(mss, byteorder='big')), 1)
+
+
+class RTTEstimator:
+    """
+    RTTEstimator keeps the smoothed RTT and RTT variance of a connection (RFC 6298)
+    and derives the retransmission timeout from them, with exponential backoff on timeouts.
+    """
+
+    def __init__(self, initialTimeout):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initialTimeout
+        self.backoff = 1
+        self.samples = 0
+        self.latest = None
+        self.minimum = None
+
+    def AddSample(self, rtt):
+        self.samples += 1
+        self.latest = rtt
+        self.minimum = rtt if self.minimum is None else min(self.minimum, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        # a fresh sample means the path delivers again
+        self.backoff = 1
+
+    def Backoff(self):
+        if self.rto * self.backoff < MAX_RTO:
+            self.backoff *= 2
+
+    def ResetBackoff(self):
+        self.backoff = 1
+
+    def Timeout(self):
+        return min(self.rto * self.backoff, MAX_RTO)
+
+
+class CongestionWindow:
+    """
+    CongestionWindow limits the number of segments in flight: slow start up to ssthresh,
+    additive increase after it and multiplicative decrease on loss.
+    """
+
+    def __init__(self):
+        self.cwnd = INITIAL_WINDOW
+        self.ssthresh = MAX_WINDOW
+
+    def OnAck(self, newlyAcked):
+        if self.cwnd < self.ssthresh:
+            # slow start
+            self.cwnd += newlyAcked
+        else:
+            # congestion avoidance, about one segment per RTT
+            self.cwnd += newlyAcked / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_WINDOW)
+
+    def OnLoss(self, inFlight, stalled, decrease=0.5):
+        self.ssthresh = max(inFlight * decrease, 2)
+        # ACKs still flowing means isolated losses, halve; a stalled path restarts from one segment
+        self.cwnd = 1 if stalled else self.ssthresh
+
+    def Window(self):
+        return max(int(self.cwnd), 1)
+
+
+class ConnectionStats:
+    """
+    ConnectionStats counts the packets and bytes a connection puts on and takes off the wire
+    and times its handshake and teardown. The per-segment counters live in the windows and the RTT estimator,
+    Snapshot gathers all of them into one dict while the connection runs.
+    """
+
+    def __init__(self):
+        self.packetsSent = 0
+        self.bytesSent = 0
+        self.packetsReceived = 0
+        self.bytesReceived = 0
+        # ACK packets sent, and ACKs that rode on a data segment instead
+        self.acksSent = 0
+        self.piggybackedAcks = 0
+        self.handshakeStartedAt = time.time()
+        self.establishedAt = None
+        self.teardownStartedAt = None
+        self.closedAt = None
+
+    def Sent(self, size):
+        self.packetsSent += 1
+        self.bytesSent += size
+
+    def Received(self, size):
+        self.packetsReceived += 1
+        self.bytesReceived += size
+
+    def HandshakeStarted(self):
+        self.handshakeStartedAt = time.time()
+        self.establishedAt = None
+
+    def Established(self):
+        if self.establishedAt is None:
+            self.establishedAt = time.time()
+
+    def TeardownStarted(self):
+        if self.teardownStartedAt is None:
+            self.teardownStartedAt = time.time()
+
+    def Closed(self):
+        if self.closedAt is None:
+            self.closedAt = time.time()
+
+    def State(self):
+        if self.closedAt is not None:
+            return 'closed'
+        if self.teardownStartedAt is not None:
+            return 'closing'
+        return 'established' if self.establishedAt is not None else 'connecting'
+
+    def Snapshot(self, rttEstimator, congestionWindow, sendWindow, receiveWindow):
+        return {
+            'state': self.State(),
+            'ageSeconds': time.time() - self.handshakeStartedAt,
+            'handshakeSeconds': self.establishedAt - self.handshakeStartedAt if self.establishedAt else None,
+            'teardownSeconds': self.closedAt - self.teardownStartedAt if self.closedAt and self.teardownStartedAt
+            else None,
+            'packetsSent': self.packetsSent,
+            'bytesSent': self.bytesSent,
+            'packetsReceived': self.packetsReceived,
+            'bytesReceived': self.bytesReceived,
+            'segmentSize': sendWindow.segmentSize if sendWindow else None,
+            'segmentsSent': sendWindow.transmissions if sendWindow else 0,
+            'retransmissions': sendWindow.retransmissions if sendWindow else 0,
+            'fastRetransmissions': sendWindow.fastRetransmissions if sendWindow else 0,
+            'duplicateAcks': sendWindow.duplicateAcks if sendWindow else 0,
+            'acksSent': self.acksSent,
+            'piggybackedAcks': self.piggybackedAcks,
+            'inFlight': sendWindow.InFlight() if sendWindow else 0,
+            'outOfOrder': receiveWindow.outOfOrder,
+            'duplicateSegments': receiveWindow.duplicates,
+            'outOfWindow': receiveWindow.outOfWindow,
+            'rttSamples': rttEstimator.samples,
+            'rttLatest': rttEstimator.latest,
+            'rttMin': rttEstimator.minimum,
+            'srtt': rttEstimator.srtt,
+            'rto': rttEstimator.Timeout(),
+            'cwnd': congestionWindow.cwnd,
+            'ssthresh': congestionWindow.ssthresh,
+        }
+
+
+def AddStats(totals, snapshot):
+    """
+    AddStats adds the counters of a ConnectionStats snapshot to totals, e.g. to sum up the connections of a server.
+    snapshot may itself be such totals, empty while a server has had no connection yet.
+    """
+    for key in SUMMED_STATS:
+        totals[key] = totals.get(key, 0) + snapshot.get(key, 0)
+    return totals
+
+
+class DelayedAck:
+    """
+    DelayedAck decides when the receiver of data segments sends its ACK. A segment that is out of order, duplicated,
+    fills a gap or is shorter than a full segment (the end of a write) is acknowledged at once; otherwise one ACK
+    covers ACK_EVERY segments or goes out ACK_DELAY seconds after the first one held back.
+    A held back ACK can also ride on a data segment going the other way, see Piggyback.
+    """
+
+    def __init__(self):
+        # segments received since the last ACK
+        self.pending = 0
+        self.deadline = None
+
+    def OnSegment(self, immediate, now):
+        """
+        OnSegment accounts for a received data segment and returns True when the ACK has to be sent now.
+        """
+        self.pending += 1
+        if immediate or self.pending >= ACK_EVERY:
+            return True
+        if self.deadline is None:
+            self.deadline = now + ACK_DELAY
+        return False
+
+    def Due(self, now):
+        return self.deadline is not None and now >= self.deadline
+
+    def Piggyback(self, payloadSize):
+        """
+        Piggyback returns True when a held back ACK number should go in front of a data segment of payloadSize bytes,
+        and considers the ACK sent then.
+        """
+        if not self.pending or payloadSize + SEQ_NUM.size > MAX_LEN - MIN_LEN:
+            return False
+        self.Sent()
+        return True
+
+    def Sent(self):
+        self.pending = 0
+        self.deadline = None
+
+
+class SegmentedPayload:
+    """
+    SegmentedPayload is data that is cut into segments once and then sent many times, e.g. a cached response
+    served to every client. The bytes stay in one contiguous buffer and the segments are memoryviews into it,
+    kept per segment size since connections may negotiate different ones.
+    """
+
+    def __init__(self, data):
+        self.data = data.encode() if isinstance(data, str) else bytes(data)
+        # segmentSize -> list of segments
+        self.segments = {}
+
+    def __len__(self):
+        return len(self.data)
+
+    def Segments(self, segmentSize):
+        segments = self.segments.get(segmentSize)
+        if segments is None:
+            view = memoryview(self.data)
+            segments = [view[offset:offset + segmentSize] for offset in range(0, len(self.data), segmentSize)]
+            # two threads cutting the same size at once store equal lists, no lock needed
+            self.segments[segmentSize] = segments
+        return segments
+
+
+class SegmentSource:
+    """
+    SegmentSource cuts data into segments lazily, only when the send window asks for the next one.
+    data is a str, a bytes-like object (sliced through a memoryview, no copy), a SegmentedPayload (its segments
+    are reused as they are), a file object opened for reading, or an iterable of str/bytes-like chunks.
+    """
+
+    def __init__(self, data, segmentSize):
+        self.segmentSize = segmentSize
+        self.view = None
+        self.segmented = None
+        self.file = None
+        self.chunks = None
+        # rest of the current chunk of an iterable
+        self.pending = memoryview(b'')
+        if isinstance(data, str):
+            data = data.encode()
+        if isinstance(data, SegmentedPayload):
+            self.segmented = iter(data.Segments(segmentSize))
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            self.view = memoryview(data).cast('B')
+        elif isinstance(data, io.TextIOBase):
+            # a text file reads characters, a segment of them can encode to more than segmentSize bytes:
+            # its reads are chunks, encoded and cut to size like any other
+            self.chunks = iter(lambda: data.read(segmentSize), '')
+        elif hasattr(data, 'read'):
+            self.file = data
+        else:
+            self.chunks = iter(data)
+
+    def Next(self):
+        """
+        Next returns the next segment, or None once the data is exhausted.
+        """
+        if self.segmented is not None:
+            return next(self.segmented, None)
+        if self.view is not None:
+            segment = self.view[:self.segmentSize]
+            self.view = self.view[self.segmentSize:]
+        elif self.file is not None:
+            segment = self.file.read(self.segmentSize)
+        else:
+            segment = self.NextFromChunks()
+        return segment if len(segment) else None
+
+    def NextFromChunks(self):
+        parts = []
+        needed = self.segmentSize
+        while needed > 0:
+            if not len(self.pending):
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.pending = memoryview(chunk.encode() if isinstance(chunk, str) else chunk).cast('B')
+                continue
+            part = self.pending[:needed]
+            self.pending = self.pending[needed:]
+            parts.append(part)
+            needed -= len(part)
+        # a segment spanning two chunks is the only copy made
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+
+class SendWindow:
+    """
+    SendWindow tracks the outstanding segments of a connection's byte stream, each with its own retransmission deadline.
+    Data is appended as SegmentSources that are segmented lazily, and only the segments that are not acknowledged
+    yet stay buffered. It does no I/O: the owner sends whatever SegmentsToSend returns and reports ACKs through Acknowledge.
+    """
+
+    def __init__(self, segmentSize, rttEstimator, congestionWindow):
+        self.segmentSize = segmentSize
+        # seq -> payload of the segments that are sent and not acknowledged yet
+        self.segments = {}
+        self.sources = deque()
+        self.rttEstimator = rttEstimator
+        self.congestionWindow = congestionWindow
+        self.sendBase = 0
+        self.nextSeq = 0
+        # losses of segments sent before this point belong to a round the window already reacted to
+        self.recoveryPoint = 0
+        # fast recovery: entered on DUPLICATE_ACK_THRESHOLD duplicate ACKs, left once recoveryPoint is acknowledged
+        self.inRecovery = False
+        self.duplicateAckRun = 0
+        # holes retransmitted in the current fast recovery, and the ones waiting for SegmentsToSend
+        self.fastRetransmitted = set()
+        self.fastRetransmits = []
+        # slowly decaying maximum RTT of single segments, how late an overtaken segment can still arrive
+        self.maxRtt = None
+        self.sacked = set()
+        # first transmission time of the segments sent exactly once, only those give RTT samples (Karn's rule)
+        self.sentAt = {}
+        # seq -> how many times the segment was retransmitted
+        self.retries = {}
+        self.lastSent = {}
+        self.lastProgressAt = 0
+        self.lastBackoffAt = 0
+        # timeouts backed off in a row without anything acknowledged in between, see ReliableConnection.Send
+        self.stalledRounds = 0
+        # seq -> retransmission deadline of every segment that is on the wire and not acknowledged
+        self.deadlines = {}
+        # (deadline, seq) min-heap, entries whose deadline was updated or acknowledged are skipped lazily
+        self.timers = []
+        # segments sent for the first time, retransmissions, and ACKs that did not move sendBase with data in flight
+        self.transmissions = 0
+        self.retransmissions = 0
+        self.duplicateAcks = 0
+        self.fastRetransmissions = 0
+
+    def IsAcked(self, seq):
+        return seq < self.sendBase or seq in self.sacked
+
+    def Append(self, data):
+        """
+        Append queues data behind whatever is still being sent, its segments continue the sequence numbers.
+        """
+        self.sources.append(SegmentSource(data, self.segmentSize))
+
+    def Finished(self):
+        return not self.sources and self.sendBase >= self.nextSeq
+
+    def Payload(self, seq):
+        return self.segments[seq]
+
+    def InFlight(self):
+        return len(self.deadlines)
+
+    def MarkSent(self, seq, now):
+        if seq in self.sentAt or seq in self.retries:
+            self.sentAt.pop(seq, None)
+            self.retries[seq] = self.retries.get(seq, 0) + 1
+            self.retransmissions += 1
+        else:
+            self.sentAt[seq] = now
+            self.transmissions += 1
+        self.lastSent[seq] = now
+        deadline = now + self.rttEstimator.Timeout()
+        self.deadlines[seq] = deadline
+        heapq.heappush(self.timers, (deadline, seq))
+
+    def Acknowledge(self, ackNumber, sackPayload, now, pure=True):
+        """
+        Acknowledge applies a cumulative ACK number plus its SACK bitmap and returns the number of newly acked segments.
+        The most recently sent of the newly acked segments feeds the RTT estimator.
+        pure is False for ACK numbers carried by data or FIN packets, whose repetition is no sign of loss.
+        """
+        newlyAcked = []
+        ackNumber = min(ackNumber, self.nextSeq)
+        duplicate = pure and ackNumber == self.sendBase and bool(self.segments)
+        advanced = ackNumber > self.sendBase
+        if advanced:
+            for seq in range(self.sendBase, ackNumber):
+                if seq in self.sacked:
+                    self.sacked.discard(seq)
+                else:
+                    newlyAcked.append(seq)
+            self.sendBase = ackNumber
+
+        for seq in DecodeSack(ackNumber, sackPayload):
+            if seq < self.nextSeq and not self.IsAcked(seq):
+                self.sacked.add(seq)
+                newlyAcked.append(seq)
+
+        latestSentAt = None
+        for seq in newlyAcked:
+            del self.segments[seq]
+            self.deadlines.pop(seq, None)
+            self.retries.pop(seq, None)
+            self.lastSent.pop(seq, None)
+            sentAt = self.sentAt.pop(seq, None)
+            if sentAt is not None:
+                self.maxRtt = now - sentAt if self.maxRtt is None else max(now - sentAt, self.maxRtt * MAX_RTT_DECAY)
+                if latestSentAt is None or sentAt > latestSentAt:
+                    latestSentAt = sentAt
+        if latestSentAt is not None:
+            self.rttEstimator.AddSample(now - latestSentAt)
+        if newlyAcked:
+            self.congestionWindow.OnAck(len(newlyAcked))
+            # the path delivers, a backed off timeout would only delay the repair of isolated losses
+            self.lastProgressAt = now
+            self.stalledRounds = 0
+            self.rttEstimator.ResetBackoff()
+
+        if duplicate:
+            self.duplicateAcks += 1
+            self.duplicateAckRun += 1
+        elif advanced:
+            self.duplicateAckRun = 0
+        if self.inRecovery and self.sendBase >= self.recoveryPoint:
+            self.inRecovery = False
+            self.fastRetransmitted.clear()
+        if self.sacked or self.duplicateAckRun >= DUPLICATE_ACK_THRESHOLD:
+            self.FastRetransmit(now)
+
+        return len(newlyAcked)
+
+    def ReorderingWindow(self):
+        """
+        ReorderingWindow is how long a hole may stay open before it counts as lost: the longest recent RTT of a segment,
+        so that segments that were only overtaken, not lost, are not retransmitted.
+        """
+        if self.rttEstimator.srtt is None:
+            return self.rttEstimator.Timeout()
+        return max(self.rttEstimator.srtt + 2 * self.rttEstimator.rttvar, self.maxRtt or 0)
+
+    def FastRetransmit(self, now):
+        """
+        FastRetransmit queues the holes the receiver reported for immediate retransmission: sendBase after
+        DUPLICATE_ACK_THRESHOLD duplicate ACKs, and any segment with that many SACKed segments above it,
+        once it is older than the ReorderingWindow. The first loss of a round shrinks the congestion window
+        by FAST_RECOVERY_DECREASE and enters fast recovery, in which every further ACK repairs the next holes,
+        so a loss costs about one RTT instead of a retransmission timeout.
+        """
+        lost = []
+        reorderingWindow = self.ReorderingWindow()
+        highestSacked = max(self.sacked) if self.sacked else self.sendBase
+        sackedAbove = 0
+        for seq in range(highestSacked, self.sendBase - 1, -1):
+            if seq in self.sacked:
+                sackedAbove += 1
+                continue
+            if seq not in self.deadlines or seq in self.fastRetransmitted:
+                continue
+            reported = sackedAbove >= DUPLICATE_ACK_THRESHOLD or (
+                seq == self.sendBase and self.duplicateAckRun >= DUPLICATE_ACK_THRESHOLD)
+            if reported and now - self.lastSent[seq] >= reorderingWindow:
+                lost.append(seq)
+        if not lost:
+            return
+
+        if not self.inRecovery:
+            # a timeout may already have reacted to this round
+            if self.sendBase >= self.recoveryPoint:
+                # SACKed segments are not in flight, with much reordering that would shrink the window to nothing
+                self.congestionWindow.OnLoss(self.congestionWindow.cwnd, False, FAST_RECOVERY_DECREASE)
+            self.recoveryPoint = self.nextSeq
+            self.inRecovery = True
+            self.fastRetransmitted.clear()
+        self.fastRetransmitted.update(lost)
+        self.fastRetransmits.extend(reversed(lost))
+
+    def DueSegments(self, now):
+        """
+        DueSegments pops every unacknowledged segment whose retransmission deadline has passed.
+        """
+        due = []
+        inFlight = self.InFlight()
+        stalled = False
+        newRound = False
+        while self.timers and self.timers[0][0] <= now:
+            deadline, seq = heapq.heappop(self.timers)
+            if self.deadlines.get(seq) == deadline:
+                del self.deadlines[seq]
+                due.append(seq)
+                # a retransmission sent after the last backoff was lost too, and nothing got acked since
+                lastSent = self.lastSent[seq]
+                if seq in self.retries and lastSent > self.lastBackoffAt and lastSent > self.lastProgressAt:
+                    stalled = True
+                if seq >= self.recoveryPoint:
+                    newRound = True
+        # back off once per stalled round, not once per expired segment
+        if stalled:
+            self.rttEstimator.Backoff()
+            self.lastBackoffAt = now
+            self.stalledRounds += 1
+        if newRound or stalled:
+            self.congestionWindow.OnLoss(inFlight, stalled)
+            self.recoveryPoint = self.nextSeq
+        return due
+
+    def SegmentsToSend(self, now):
+        """
+        SegmentsToSend returns the expired segments to retransmit followed by the new segments
+        the congestion window allows, never running more than MAX_WINDOW past sendBase.
+        """
+        toSend = self.DueSegments(now)
+        # holes found by FastRetransmit go first, their timers are replaced when they are sent again
+        fastRetransmits = []
+        for seq in self.fastRetransmits:
+            # skips the ones acknowledged meanwhile or queued twice
+            if self.deadlines.pop(seq, None) is not None:
+                fastRetransmits.append(seq)
+        self.fastRetransmissions += len(fastRetransmits)
+        toSend[:0] = fastRetransmits
+        self.fastRetransmits.clear()
+        room = self.congestionWindow.Window() - self.InFlight() - len(toSend)
+        while room > 0 and self.sources and self.nextSeq < self.sendBase + MAX_WINDOW:
+            payload = self.sources[0].Next()
+            if payload is None:
+                self.sources.popleft()
+                continue
+            self.segments[self.nextSeq] = payload
+            toSend.append(self.nextSeq)
+            self.nextSeq += 1
+            room -= 1
+        return toSend
+
+    def NextDeadline(self):
+        while self.timers:
+            deadline, seq = self.timers[0]
+            if self.deadlines.get(seq) == deadline:
+                return deadline
+            heapq.heappop(self.timers)
+        return None
+
+
+class StreamReader:
+    """
+    StreamReader reads delimited and fixed-size pieces from an iterator of byte chunks such as ReceiveStream,
+    so several messages can follow each other on one connection.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def Fill(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer += chunk
+        return True
+
+    def ReadUntil(self, delimiter):
+        """
+        ReadUntil returns the bytes up to and including delimiter, or None if the stream ends before it.
+        """
+        start = 0
+        while True:
+            index = self.buffer.find(delimiter, start)
+            if index >= 0:
+                end = index + len(delimiter)
+                data = bytes(self.buffer[:end])
+                del self.buffer[:end]
+                return data
+            # the delimiter may straddle the next chunk
+            start = max(len(self.buffer) - len(delimiter) + 1, 0)
+            if not self.Fill():
+                return None
+
+    def ReadChunks(self, size):
+        """
+        ReadChunks yields the next size bytes as they arrive, fewer if the stream ends before.
+        """
+        while size > 0:
+            if not self.buffer and not self.Fill():
+                return
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            size -= len(data)
+            yield data
+
+    def Read(self, size):
+        return b''.join(self.ReadChunks(size))
+
+
+class ReceiveWindow:
+    """
+    ReceiveWindow reassembles the in-order byte stream from segments arriving in any order.
+    Out-of-order segments wait in a ring of MAX_WINDOW slots and an int bitmap marks which ones are held,
+    so the cumulative ACK number advances incrementally instead of being recomputed per packet.
+    """
+
+    def __init__(self, size=MAX_WINDOW):
+        self.size = size
+        self.slots = [None] * size
+        # cumulative ACK number: every segment before it was delivered in order
+        self.nextExpected = 0
+        # bit i is set when segment nextExpected + i is held
+        self.bitmap = 0
+        self.data = bytearray()
+        # segments that arrived ahead of a gap, that were already received, and that were beyond the window
+        self.outOfOrder = 0
+        self.duplicates = 0
+        self.outOfWindow = 0
+
+    def Insert(self, seq, payload):
+        """
+        Insert stores a segment and delivers the in-order run it completes.
+        Returns False for duplicates and for segments beyond the window.
+        """
+        offset = seq - self.nextExpected
+        if offset >= self.size:
+            self.outOfWindow += 1
+            return False
+        if offset < 0 or self.bitmap >> offset & 1:
+            self.duplicates += 1
+            return False
+        if offset > 0:
+            self.outOfOrder += 1
+
+        self.slots[seq % self.size] = payload
+        self.bitmap |= 1 << offset
+        if offset == 0:
+            # length of the run of held segments starting at nextExpected
+            run = (~self.bitmap & (self.bitmap + 1)).bit_length() - 1
+            for seq in range(self.nextExpected, self.nextExpected + run):
+                slot = seq % self.size
+                self.data += self.slots[slot]
+                self.slots[slot] = None
+            self.bitmap >>= run
+            self.nextExpected += run
+        return True
+
+    def AckNumber(self):
+        return self.nextExpected
+
+    def HasGap(self):
+        return self.bitmap != 0
+
+    def Available(self):
+        """
+        Available is the number of in-order bytes delivered and not taken yet.
+        """
+        return len(self.data)
+
+    def SackPayload(self):
+        """
+        SackPayload is the selective-acknowledgement bitmap carried in the payload of an ACK.
+        Bit i (little-endian) is set when segment AckNumber() + 1 + i is already held.
+        """
+        sack = self.bitmap >> 1
+        return sack.to_bytes((sack.bit_length() + 7) // 8, byteorder='little')
+
+    def Take(self):
+        """
+        Take returns the in-order bytes delivered since the previous call.
+        """
+        data = bytes(self.data)
+        self.data.clear()
+        return data
+
+
+class ReliableConnection:
+    """
+    ReliableConnection is the data transfer of one connection, the same for both roles: it sends a byte stream as
+    selective-repeat segments, reassembles the peer's and acknowledges it with delayed, SACKing ACKs.
+    ReliableClient and ServerConnection add their side of the handshake and teardown and feed it the received
+    packets through HandlePacket. Its state is guarded by stateCondition, the timers run on the shared wheel.
+    """
+
+    def __init__(self, connection, destination, peerAddress, peerPort, segmentSize, timeoutInterval):
+        # socket the datagrams go out through and the address they go to, the router's or the one they came from
+        self.connection = connection
+        self.destination = destination
+        self.peerAddress = peerAddress
+        self.peerPort = peerPort
+        # header of our data packets, only the sequence number is patched in per segment
+        self.dataHeader = HeaderTemplate(0, peerAddress, peerPort)
+        # data packets carrying our cumulative ACK number in front of the data
+        self.dataAckHeader = HeaderTemplate(6, peerAddress, peerPort)
+        self.segmentSize = segmentSize
+        # initial retransmission timeout, adapted to the measured RTT once samples arrive
+        self.timeoutInterval = timeoutInterval
+        self.rttEstimator = RTTEstimator(timeoutInterval)
+        self.congestionWindow = CongestionWindow()
+        self.sendBase = 0
+        self.receiveWindow = ReceiveWindow()
+        self.delayedAck = DelayedAck()
+        self.sendWindow = None
+        self.stateCondition = threading.Condition()
+        # retransmission, FIN and delayed ACK deadlines are timers of the wheel shared by the connections
+        self.timers = SharedTimerWheel()
+        self.ackTimer = None
+        self.wakeTimer = None
+        self.wakeDeadline = None
+        self.FINACK = False
+        # the peer's FIN arrived, its data is complete
+        self.peerClosed = False
+        self.stats = ConnectionStats()
+
+    def SendDatagram(self, datagram):
+        try:
+            self.connection.sendto(datagram, self.destination)
+            self.stats.Sent(len(datagram))
+        except Exception as e:
+            print(e)
+
+    def SingleSend(self, packetType, seq_num, data):
+        p = Packet(packet_type=packetType,
+                   seq_num=seq_num,
+                   peer_ip_addr=self.peerAddress,
+                   peer_port=self.peerPort,
+                   payload=data)
+        self.SendDatagram(p.to_bytes())
+        # print('sent type:', p.packet_type)
+
+    def SendSegment(self, seq_num, payload):
+        # data hot path, called by Send only: no Packet object per segment
+        if self.delayedAck.Piggyback(len(payload)):
+            # the ACK we hold back for the peer rides on the segment instead of a packet of its own
+            datagram = self.dataAckHeader.datagram(seq_num, SEQ_NUM.pack(self.GetAckNumber()) + payload)
+            self.stats.piggybackedAcks += 1
+        else:
+            datagram = self.dataHeader.datagram(seq_num, payload)
+        self.SendDatagram(datagram)
+
+    def PeerStopsReading(self):
+        """
+        PeerStopsReading tells whether the peer will not read what is still being sent. Callers hold stateCondition.
+        """
+        return False
+
+    def Send(self, data):
+        """
+        Send streams data (str, bytes, file object or iterable of chunks) over the open connection
+        and returns once all of it is acknowledged. Only the segments in flight are held in memory.
+        Raises ConnectionError when the peer closes the connection before that, or stops answering:
+        MAX_RETRIES backed off timeouts in a row, like the SYN and FIN retransmissions.
+        """
+        with self.stateCondition:
+            self.sendWindow.Append(data)
+            # selective repeat: resend only the segments whose own retransmission timer expired,
+            # and put new ones on the wire only as far as the congestion window allows
+            while not self.sendWindow.Finished():
+                if self.PeerStopsReading():
+                    raise ConnectionError("connection closed by the peer")
+                if self.sendWindow.stalledRounds > MAX_RETRIES:
+                    raise ConnectionError("no ACK from {}:{}".format(self.peerAddress, self.peerPort))
+                now = time.time()
+                for seq in self.sendWindow.SegmentsToSend(now):
+                    self.SendSegment(seq, self.sendWindow.Payload(seq))
+                    self.sendWindow.MarkSent(seq, now)
+                nextDeadline = self.sendWindow.NextDeadline()
+                if nextDeadline is not None:
+                    self.WaitUntil(nextDeadline)
+
+    def ReceiveStream(self):
+        """
+        ReceiveStream yields the received bytes in order, chunk by chunk as soon as the in-order prefix grows,
+        and stops once the peer's FIN arrived and everything before it was yielded.
+        """
+        while True:
+            with self.stateCondition:
+                self.stateCondition.wait_for(lambda: self.receiveWindow.Available() or self.peerClosed)
+                chunk = self.receiveWindow.Take()
+            if not chunk:
+                return
+            yield chunk
+
+    def WaitForData(self, timeout):
+        """
+        WaitForData waits up to timeout seconds for received data or the peer's FIN and returns whether either came.
+        """
+        deadline = time.time() + timeout
+        with self.stateCondition:
+            while not (self.receiveWindow.Available() or self.peerClosed):
+                if time.time() >= deadline:
+                    return False
+                self.WaitUntil(deadline)
+            return True
+
+    def GetStats(self):
+        """
+        GetStats returns the counters and gauges of the connection, see ConnectionStats.Snapshot.
+        It can be called from any thread while a transfer is running.
+        """
+        stats = self.stats.Snapshot(self.rttEstimator, self.congestionWindow, self.sendWindow, self.receiveWindow)
+        stats['peer'] = '%s:%d' % (self.peerAddress, self.peerPort)
+        return stats
+
+    def GetAckNumber(self):
+        return self.receiveWindow.AckNumber()
+
+    def SendAck(self):
+        with self.stateCondition:
+            self.delayedAck.Sent()
+            # one snapshot: the reception thread may insert between two reads, and a SACK bitmap read after the
+            # ACK number moved would mark segments as received that never were
+            ackNumber = self.GetAckNumber()
+            # payload carries the SACK bitmap of out-of-order segments already received
+            sackPayload = self.receiveWindow.SackPayload()
+        self.stats.acksSent += 1
+        self.SingleSend(3, ackNumber, sackPayload)
+
+    def ReceiveSegment(self, seq_num, payload):
+        """
+        ReceiveSegment stores a data segment and returns True when it has to be acknowledged right away,
+        otherwise the ACK is held back until the delayedAck deadline, see DelayedAck. Callers hold stateCondition.
+        """
+        hadGap = self.receiveWindow.HasGap()
+        inserted = self.receiveWindow.Insert(seq_num, payload)
+        if inserted and self.receiveWindow.Available():
+            self.stateCondition.notify_all()
+        immediate = not inserted or hadGap or self.receiveWindow.HasGap() or len(payload) < self.segmentSize
+        if self.delayedAck.OnSegment(immediate, time.time()):
+            return True
+        if self.ackTimer is None:
+            self.ackTimer = self.timers.Schedule(self.delayedAck.deadline, self.OnAckTimer)
+        return False
+
+    def OnAckTimer(self):
+        with self.stateCondition:
+            self.ackTimer = None
+            due = self.delayedAck.Due(time.time())
+            if not due and self.delayedAck.deadline is not None:
+                # the ACK it was armed for went out, a later one is held back now
+                self.ackTimer = self.timers.Schedule(self.delayedAck.deadline, self.OnAckTimer)
+        if due:
+            self.SendAck()
+
+    def WaitUntil(self, deadline):
+        # callers hold stateCondition: wait for a notification, at the latest until the wheel's timer at deadline;
+        # a timer armed for an earlier deadline is kept, waking up early only costs another look at the state
+        if self.wakeTimer is None or not self.wakeTimer.Pending() or self.wakeDeadline > deadline:
+            if self.wakeTimer is not None:
+                self.wakeTimer.Cancel()
+            self.wakeTimer = self.timers.Schedule(deadline, self.Wake)
+            self.wakeDeadline = deadline
+        self.stateCondition.wait()
+
+    def Wake(self):
+        with self.stateCondition:
+            self.stateCondition.notify_all()
+
+    def HandlePacket(self, packet):
+        """
+        HandlePacket processes the packets of the data transfer, the subclasses handle the handshake and FIN first.
+        """
+        # ACK
+        if packet.packet_type == 3:
+            if packet.seq_num > self.sendBase:
+                self.sendBase = packet.seq_num
+            with self.stateCondition:
+                if self.sendWindow is not None:
+                    self.sendWindow.Acknowledge(packet.seq_num, packet.payload, time.time())
+                    self.stateCondition.notify_all()
+
+        # data, also completes the handshake when the SYNACK echo got lost
+        elif packet.packet_type == 0:
+            self.stats.Established()
+            with self.stateCondition:
+                ackNow = self.ReceiveSegment(packet.seq_num, packet.payload)
+            if ackNow:
+                self.SendAck()
+
+        # data with the peer's cumulative ACK number piggybacked
+        elif packet.packet_type == 6:
+            self.stats.Established()
+            ackNumber, payload = SplitPiggybackedAck(packet.payload)
+            if ackNumber > self.sendBase:
+                self.sendBase = ackNumber
+            with self.stateCondition:
+                if self.sendWindow is not None:
+                    self.sendWindow.Acknowledge(ackNumber, b'', time.time(), pure=False)
+                    self.stateCondition.notify_all()
+                ackNow = self.ReceiveSegment(packet.seq_num, payload)
+            if ackNow:
+                self.SendAck()
+
+        # FINACK
+        elif packet.packet_type == 5:
+            with self.stateCondition:
+                self.FINACK = True
+                self.stateCondition.notify_all()
@@ -0,0 +1,62 @@
+##byte-bounded LRU cache of fully rendered HTTP responses, used by httpfs##
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    ResponseCache maps a key (the request path) to a rendered response, bytes or a SegmentedPayload,
+    and the validator it was rendered for, e.g. (mtime, size) of the file. A lookup with a different validator is a miss,
+    so a file changed on disk is never served stale. The least recently used entries are evicted
+    once the cached responses exceed capacity bytes; responses over maxEntrySize are not cached at all.
+    """
+
+    def __init__(self, capacity, maxEntrySize=None):
+        self.capacity = capacity
+        self.maxEntrySize = maxEntrySize if maxEntrySize is not None else capacity // 4
+        # key -> (validator, response), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # handlers of different connections run in their own threads
+        self.lock = threading.Lock()
+
+    def Fits(self, size):
+        return 0 < size <= min(self.maxEntrySize, self.capacity)
+
+    def Get(self, key, validator):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != validator:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def Put(self, key, validator, response):
+        if not self.Fits(len(response)):
+            return
+        with self.lock:
+            self.Remove(key)
+            self.entries[key] = (validator, response)
+            self.size += len(response)
+            while self.size > self.capacity:
+                oldKey, (oldValidator, oldResponse) = self.entries.popitem(last=False)
+                self.size -= len(oldResponse)
+
+    def Stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size, 'capacity': self.capacity,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def Invalidate(self, key):
+        with self.lock:
+            self.Remove(key)
+
+    def Remove(self, key):
+        # callers hold the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
@@ -0,0 +1,198 @@
+##one UDP port served by several ReliableServer processes, each connection pinned to one of them##
+import multiprocessing
+import multiprocessing.connection
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+from multiprocessing.managers import SyncManager
+from packet import MIN_LEN, SEQ_NUM
+from ReliableServer import HANDLER_QUEUE, HANDLERS, ReliableServer
+from ReliableTransport import AddStats
+
+# peer_ip_addr and peer_port of the packet header, the client's address once the router rewrote it
+PEER = slice(1 + SEQ_NUM.size, MIN_LEN)
+
+# sender of a steered datagram (IPv4, port) in front of it, the router's address the worker replies to
+SENDER = struct.Struct('>4sH')
+
+# bytes of steered datagrams queued to a worker before the front drops further ones
+INBOX_BUFFER = 4 * 1024 * 1024
+
+# seconds between the stats a worker publishes, the numbers of the other workers are at most that old
+STATS_INTERVAL = 1.0
+
+
+class SteeredSocket:
+    """
+    SteeredSocket is the connection of one worker: datagrams come from its inbox as the front steered them,
+    replies go out through the shared server socket, so the clients still see the server port.
+    """
+
+    def __init__(self, connection, inbox):
+        self.connection = connection
+        self.inbox = inbox
+
+    def recvfrom(self, bufsize):
+        datagram = self.inbox.recv(SENDER.size + bufsize)
+        address, port = SENDER.unpack_from(datagram)
+        return datagram[SENDER.size:], (socket.inet_ntoa(address), port)
+
+    def sendto(self, data, address):
+        return self.connection.sendto(data, address)
+
+
+def ExitWithParent():
+    # the workers and the stats manager hold the port or the stats, they end with the front however it is killed
+    parent = multiprocessing.parent_process()
+
+    def Watch():
+        multiprocessing.connection.wait([parent.sentinel])
+        os._exit(0)
+
+    threading.Thread(target=Watch, daemon=True).start()
+
+
+def MergePoolStats(poolStatsList):
+    # HandlerPool.Stats of the workers: everything adds up but the longest queue wait
+    merged = {}
+    for poolStats in poolStatsList:
+        for key, value in poolStats.items():
+            merged[key] = max(merged.get(key, 0), value) if key == 'maxQueueWait' else merged.get(key, 0) + value
+    return merged
+
+
+def MergeStats(statsList):
+    """
+    MergeStats sums the ReliableServer.GetStats of several servers into one of the same shape.
+    """
+    totals = {}
+    for stats in statsList:
+        AddStats(totals, stats['totals'])
+    merged = {'openConnections': sum(stats['openConnections'] for stats in statsList),
+              'closedConnections': sum(stats['closedConnections'] for stats in statsList),
+              'totals': totals,
+              'handlers': MergePoolStats([stats['handlers'] for stats in statsList])}
+    if any('shedHandlers' in stats for stats in statsList):
+        merged['shedHandlers'] = MergePoolStats([stats['shedHandlers'] for stats in statsList])
+    merged['connections'] = [snapshot for stats in statsList for snapshot in stats['connections']]
+    return merged
+
+
+class ShardedServer:
+    """
+    ShardedServer runs workers ReliableServers in forked processes on one port, so that packet handling and the
+    handlers of different connections run on different cores instead of sharing one interpreter lock.
+    The parent binds the port and steers every datagram by a hash of the client address in its header to one
+    worker, all datagrams of a connection thus reach the same worker. SO_REUSEPORT cannot do this here:
+    the kernel hashes the UDP source address, and everything arrives from the one address of the router.
+    """
+
+    def __init__(self, serverport, workers, segmentSize=None, timeoutInterval=0.5, fastOpen=False, handlers=HANDLERS,
+                 queueSize=HANDLER_QUEUE, overload='refuse'):
+        self.serverPort = serverport
+        self.workers = workers
+        self.segmentSize = segmentSize
+        self.timeoutInterval = timeoutInterval
+        self.fastOpen = fastOpen
+        # per worker, see ReliableServer
+        self.handlers = handlers
+        self.queueSize = queueSize
+        self.overload = overload
+        self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # (front end, worker end) per worker
+        self.inboxes = []
+        # datagrams dropped because their worker fell behind, like a full socket buffer drops them
+        self.dropped = 0
+        # set in each worker process
+        self.index = None
+        self.server = None
+        self.workerStats = None
+        # worker index -> its last published stats, shared through a manager process
+        self.published = None
+        self.processes = []
+
+    def RunServer(self, serverHandler, streaming=False, workerStats=None, overloadHandler=None):
+        """
+        RunServer forks the workers, each runs ReliableServer.RunServer(serverHandler, streaming, overloadHandler),
+        and steers the datagrams to them from a thread of this process. workerStats() returns counters of the
+        application in a worker, e.g. of its cache, published and summed with the transport stats, see GetStats.
+        The server has to be created and assigned before RunServer, the workers see only what exists when they fork.
+        """
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            print("Workers need fork, serve without -w on this platform")
+            return
+        try:
+            self.connection.bind(('', self.serverPort))
+            manager = SyncManager(ctx=context)
+            manager.start(ExitWithParent)
+            self.published = manager.dict()
+            for index in range(self.workers):
+                front, worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+                front.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, INBOX_BUFFER)
+                front.setblocking(False)
+                self.inboxes.append((front, worker))
+            for index in range(self.workers):
+                process = context.Process(target=self.Worker, daemon=True,
+                                          args=(index, serverHandler, streaming, workerStats, overloadHandler))
+                process.start()
+                self.processes.append(process)
+            print("Server is listening at port: ", self.serverPort, "with", self.workers, "workers")
+            threading.Thread(target=self.Steer).start()
+        except Exception as e:
+            print(e)
+
+    def Steer(self):
+        inboxes = [front for front, worker in self.inboxes]
+        while True:
+            try:
+                datagram, sender = self.connection.recvfrom(1024)
+                if len(datagram) < MIN_LEN:
+                    continue
+                inbox = inboxes[zlib.crc32(datagram[PEER]) % len(inboxes)]
+                try:
+                    inbox.send(SENDER.pack(socket.inet_aton(sender[0]), sender[1]) + datagram)
+                except BlockingIOError:
+                    self.dropped += 1
+            except Exception as e:
+                print(e)
+
+    def Worker(self, index, serverHandler, streaming, workerStats, overloadHandler):
+        ExitWithParent()
+        self.index = index
+        self.workerStats = workerStats
+        for front, worker in self.inboxes:
+            front.close()
+        self.server = ReliableServer(self.serverPort, self.segmentSize, self.timeoutInterval, self.fastOpen,
+                                     self.handlers, self.queueSize, self.overload,
+                                     connection=SteeredSocket(self.connection, self.inboxes[index][1]))
+        self.server.RunServer(serverHandler, streaming, overloadHandler)
+        while True:
+            self.Publish()
+            time.sleep(STATS_INTERVAL)
+
+    def Publish(self):
+        stats = self.server.GetStats()
+        self.published[self.index] = {'transport': stats,
+                                      'application': self.workerStats() if self.workerStats else {}}
+
+    def GetStats(self):
+        """
+        GetStats, called in a worker, returns the transport stats merged over all workers like ReliableServer.GetStats
+        plus 'workers', the transport totals, handler pool and application counters of each worker.
+        The caller's own worker is up to date, the others as of their last publication.
+        """
+        self.Publish()
+        published = dict(self.published)
+        workers = [published[index] for index in sorted(published)]
+        merged = MergeStats([worker['transport'] for worker in workers])
+        merged['workers'] = [{'worker': index, 'openConnections': worker['transport']['openConnections'],
+                              'closedConnections': worker['transport']['closedConnections'],
+                              'totals': worker['transport']['totals'], 'handlers': worker['transport']['handlers'],
+                              'application': worker['application']}
+                             for index, worker in zip(sorted(published), workers)]
+        return merged
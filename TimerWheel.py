@@ -0,0 +1,216 @@
+##hierarchical timing wheel shared by the threaded connections for their retransmission, delayed ACK and FIN timers##
+import math
+import os
+import threading
+import time
+
+# resolution of the wheel in seconds, a timer never fires before its deadline and at most about a tick after it
+TICK = 0.001
+
+# slots per level as a power of two, and levels: 64 ** 4 ticks cover about 4.6 hours, later deadlines are clamped
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+LEVELS = 4
+
+_sharedWheel = None
+_sharedWheelLock = threading.Lock()
+
+
+def SharedTimerWheel():
+    """
+    SharedTimerWheel returns the running TimerWheel of the process, started on first use.
+    """
+    global _sharedWheel
+    with _sharedWheelLock:
+        if _sharedWheel is None:
+            _sharedWheel = TimerWheel().Start()
+        return _sharedWheel
+
+
+def _ForgetSharedWheel():
+    # a forked child, e.g. a worker of a ShardedServer, inherits no wheel thread: it starts its own on first use
+    global _sharedWheel, _sharedWheelLock
+    _sharedWheel = None
+    _sharedWheelLock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_ForgetSharedWheel)
+
+
+class Timer:
+    """
+    Timer is a callback scheduled on a TimerWheel, Cancel takes it off in constant time.
+    """
+
+    __slots__ = ('wheel', 'tick', 'callback', 'level', 'slot')
+
+    def __init__(self, wheel, tick, callback):
+        self.wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.level = None
+        # the set of the wheel slot holding the timer, None once it fired or was cancelled
+        self.slot = None
+
+    def Cancel(self):
+        with self.wheel.condition:
+            if self.slot is not None:
+                self.slot.discard(self)
+                self.slot = None
+                self.wheel.levelCounts[self.level] -= 1
+                self.wheel.count -= 1
+
+    def Pending(self):
+        return self.slot is not None
+
+
+class TimerWheel:
+    """
+    TimerWheel runs callbacks at their deadlines (time.time() seconds) from one daemon thread (Varghese & Lauck).
+    Level 0 has a slot per tick for the next SLOTS ticks, every further level a slot per SLOTS ticks of the level
+    below; a timer goes into the lowest level that reaches its deadline and moves down a level whenever the ticks
+    reach its slot. Schedule and Cancel are O(1) whatever the number of timers, and the thread sleeps until
+    the nearest occupied slot instead of ticking, so idle timers cost no CPU.
+    Callbacks run on the wheel thread, outside its lock, and have to be short.
+    """
+
+    def __init__(self):
+        self.origin = time.time()
+        # [level][slot] -> set of Timers
+        self.levels = [[set() for slot in range(SLOTS)] for level in range(LEVELS)]
+        # ticks before this one are processed
+        self.current = 0
+        self.count = 0
+        self.levelCounts = [0] * LEVELS
+        self.condition = threading.Condition()
+        # tick the thread sleeps until, None while it waits for a first timer
+        self.wakeTick = None
+        self.running = False
+
+    def Start(self):
+        self.running = True
+        threading.Thread(target=self.Run, daemon=True).start()
+        return self
+
+    def Stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def Schedule(self, deadline, callback):
+        """
+        Schedule calls callback() at deadline and returns its Timer, a deadline already past fires on the next tick.
+        """
+        with self.condition:
+            if not self.count:
+                # nothing was scheduled, skip the ticks the thread slept through
+                self.current = max(self.current, self.Tick(time.time()))
+            timer = Timer(self, max(math.ceil((deadline - self.origin) / TICK), self.current), callback)
+            self.Insert(timer)
+            if self.wakeTick is None or timer.tick < self.wakeTick:
+                self.condition.notify()
+            return timer
+
+    def ScheduleAfter(self, delay, callback):
+        return self.Schedule(time.time() + delay, callback)
+
+    def Tick(self, now):
+        return int((now - self.origin) / TICK)
+
+    def Insert(self, timer):
+        # callers hold the condition
+        delta = timer.tick - self.current
+        for level in range(LEVELS):
+            if delta < SLOTS << (SLOT_BITS * level) or level == LEVELS - 1:
+                break
+        if level == LEVELS - 1 and delta >= SLOTS << (SLOT_BITS * level):
+            # beyond the last level: parked in its farthest slot and placed again once it cascades down
+            slot = ((self.current >> (SLOT_BITS * level)) - 1) & SLOT_MASK
+        else:
+            slot = (timer.tick >> (SLOT_BITS * level)) & SLOT_MASK
+        timer.level = level
+        timer.slot = self.levels[level][slot]
+        timer.slot.add(timer)
+        self.levelCounts[level] += 1
+        self.count += 1
+
+    def Cascade(self, level):
+        # callers hold the condition: the slot of level that the ticks just reached is spread over the levels below
+        slot = self.levels[level][(self.current >> (SLOT_BITS * level)) & SLOT_MASK]
+        timers = list(slot)
+        slot.clear()
+        self.levelCounts[level] -= len(timers)
+        self.count -= len(timers)
+        for timer in timers:
+            self.Insert(timer)
+
+    def Advance(self, nowTick):
+        """
+        Advance processes the ticks up to nowTick and returns the timers that expired. Callers hold the condition.
+        """
+        expired = []
+        while self.current <= nowTick and self.count:
+            index = self.current & SLOT_MASK
+            if index == 0:
+                for level in range(1, LEVELS):
+                    self.Cascade(level)
+                    if (self.current >> (SLOT_BITS * level)) & SLOT_MASK:
+                        break
+            elif not self.levelCounts[0]:
+                # nothing on level 0, jump to where it wraps and the level above cascades
+                self.current = min((self.current | SLOT_MASK) + 1, nowTick + 1)
+                continue
+            slot = self.levels[0][index]
+            if slot:
+                for timer in slot:
+                    timer.slot = None
+                    expired.append(timer)
+                self.levelCounts[0] -= len(slot)
+                self.count -= len(slot)
+                slot.clear()
+            self.current += 1
+        self.current = max(self.current, nowTick + 1)
+        return expired
+
+    def NextTick(self):
+        """
+        NextTick is the first tick at which a timer may expire or has to move down a level, None without timers.
+        Callers hold the condition.
+        """
+        if not self.count:
+            return None
+        for level in range(LEVELS):
+            shift = SLOT_BITS * level
+            base = self.current >> shift
+            # above level 0 the current slot is due for its cascade only when the ticks are right at its start,
+            # otherwise it already cascaded and holds timers of the next round of that level
+            first = 0 if self.current & ((1 << shift) - 1) == 0 else 1
+            for step in range(first, SLOTS - (base & SLOT_MASK)):
+                if self.levels[level][(base + step) & SLOT_MASK]:
+                    return (base + step) << shift
+            if self.levelCounts[level]:
+                # wraps before anything of it is due, the level above cascades there too
+                return ((base | SLOT_MASK) + 1) << shift
+        return None
+
+    def Run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    nowTick = self.Tick(time.time())
+                    self.wakeTick = self.NextTick()
+                    if self.wakeTick is not None and self.wakeTick <= nowTick:
+                        break
+                    self.condition.wait(self.wakeTick * TICK + self.origin - time.time()
+                                        if self.wakeTick is not None else None)
+                if not self.running:
+                    return
+                self.wakeTick = None
+                expired = self.Advance(nowTick)
+            for timer in expired:
+                try:
+                    timer.callback()
+                except Exception as e:
+                    print(e)
@@ -0,0 +1,200 @@
+##benchmark of the reliable transport over the lossy Python router: goodput, completion time percentiles, overhead##
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from ReliableClient import ReliableClient
+from ReliableServer import ReliableServer
+from ReliableTransport import MAX_SEGMENT_SIZE
+from router import ParseDuration, Router
+
+# command line arguments
+parser = argparse.ArgumentParser(description='Measures ReliableClient <-> ReliableServer (and httpc <-> httpfs) '
+                                             'transfers over router.py across a grid of link conditions')
+parser.add_argument('-s', '--segment-size', type=int, action='append', help='Segment size (repeatable)')
+parser.add_argument('-p', '--payload', type=int, action='append', help='Request payload size in bytes (repeatable)')
+parser.add_argument('--drop-rate', type=float, action='append', help='Drop rate of the router (repeatable)')
+parser.add_argument('--max-delay', type=str, action='append', help='Max delay of the router, e.g. 5ms (repeatable)')
+parser.add_argument('-r', '--repeat', type=int, default=5, help='Transfers per grid cell')
+parser.add_argument('--seed', type=int, default=1, help='Seed of the router, every cell starts from it')
+parser.add_argument('--timeout', type=float, default=60, help='Seconds after which a transfer counts as failed')
+parser.add_argument('--http', action='store_true', help='Also run httpc batch GETs against httpfs')
+parser.add_argument('--server-port', type=int, default=8090, help='Port of the echo server (httpfs uses the next one)')
+parser.add_argument('-o', '--output', help='Write the results as JSON to this file')
+parser.add_argument('--baseline', help='JSON results of an earlier run to compare the goodput with')
+
+HTTPC_RESULT = re.compile(r'^#(\d+) GET \S+ -> (\d+), (\d+) bytes, ([0-9.]+)s$')
+
+
+def Percentile(values, percent):
+    # nearest rank, so p99 of a handful of runs is their maximum
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, -(-len(ordered) * percent // 100) - 1))]
+
+
+def RunEchoServer(port):
+    # answers every request with its length, so the response does not weigh on the measured direction
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        ReliableServer(port).RunServer(lambda data, connection: connection.Transfer(str(len(data))))
+        threading.Event().wait()
+
+
+def TimedTransfer(routerPort, serverPort, segmentSize, message, timeout):
+    """
+    TimedTransfer returns the seconds one ReliableClient.Transfer of message took, or None if it failed or timed out.
+    """
+    result = {}
+
+    def Transfer():
+        start = time.perf_counter()
+        response = ReliableClient('localhost', routerPort, 'localhost', serverPort, segmentSize).Transfer(message)
+        if response == str(len(message)):
+            result['seconds'] = time.perf_counter() - start
+
+    # a transfer stuck on a dead peer must not stop the benchmark, its thread is left behind
+    thread = threading.Thread(target=Transfer, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    return result.get('seconds')
+
+
+def Summarize(cell, payload, durations, failures, before, after):
+    delivered = payload * len(durations)
+    packets = after['received'] - before['received']
+    cell.update({
+        'transfers': len(durations),
+        'failures': failures,
+        'goodput': delivered / sum(durations) if durations else 0,
+        'p50': Percentile(durations, 50),
+        'p99': Percentile(durations, 99),
+        'packets': packets,
+        'packets_per_byte': packets / delivered if delivered else None,
+        'retransmissions': after['retransmitted'] - before['retransmitted'],
+        'dropped': after['dropped'] - before['dropped'],
+    })
+    return cell
+
+
+def MeasureTransport(args, segmentSize, payload, dropRate, maxDelay):
+    router = Router(0, dropRate, ParseDuration(maxDelay), args.seed).Start()
+    message = ''.join(chr(65 + i % 26) for i in range(payload))
+    durations = []
+    failures = 0
+    before = router.Stats()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(args.repeat):
+            seconds = TimedTransfer(router.port, args.server_port, segmentSize, message, args.timeout)
+            if seconds is None:
+                failures += 1
+            else:
+                durations.append(seconds)
+    after = router.Stats()
+    router.Stop()
+    cell = {'mode': 'transport', 'segment_size': segmentSize, 'payload': payload, 'drop_rate': dropRate,
+            'max_delay': maxDelay}
+    return Summarize(cell, payload, durations, failures, before, after)
+
+
+def MeasureHttp(args, directory, segmentSize, payload, dropRate, maxDelay):
+    router = Router(0, dropRate, ParseDuration(maxDelay), args.seed).Start()
+    batchFile = os.path.join(directory, 'batch-%d.txt' % payload)
+    with open(batchFile, 'w') as file:
+        for i in range(args.repeat):
+            file.write("GET http://localhost:%d/payload-%d.txt\n" % (args.server_port + 1, payload))
+    before = router.Stats()
+    # one request at a time over a kept-alive connection, the per request times come from httpc's batch report
+    try:
+        output = subprocess.run([sys.executable, 'httpc.py', 'batch', batchFile, '-c', '1', '--mss', str(segmentSize),
+                                 '--router-port', str(router.port)], capture_output=True, text=True,
+                                timeout=args.timeout * args.repeat, cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).stdout
+    except subprocess.TimeoutExpired:
+        output = ''
+    after = router.Stats()
+    router.Stop()
+    durations = [float(match.group(4)) for match in map(HTTPC_RESULT.match, output.splitlines())
+                 if match and match.group(2) == '200']
+    cell = {'mode': 'http', 'segment_size': segmentSize, 'payload': payload, 'drop_rate': dropRate,
+            'max_delay': maxDelay}
+    return Summarize(cell, payload, durations, args.repeat - len(durations), before, after)
+
+
+def Commit():
+    # the version measured, so that result files of different versions can be told apart
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def CellKey(cell):
+    return cell['mode'], cell['segment_size'], cell['payload'], cell['drop_rate'], cell['max_delay']
+
+
+def PrintCell(cell, baseline):
+    line = "%-9s seg %5d  payload %8d  drop %.2f  delay %-5s  goodput %10.0f B/s  p50 %s  p99 %s  %.3f pkts/KB  " \
+           "%d retx  %d failed" % (
+               cell['mode'], cell['segment_size'], cell['payload'], cell['drop_rate'], cell['max_delay'],
+               cell['goodput'], '%.3fs' % cell['p50'] if cell['p50'] is not None else '-',
+               '%.3fs' % cell['p99'] if cell['p99'] is not None else '-',
+               cell['packets_per_byte'] * 1024 if cell['packets_per_byte'] is not None else 0,
+               cell['retransmissions'], cell['failures'])
+    previous = baseline.get(CellKey(cell))
+    if previous is not None and previous['goodput']:
+        line += "  (%+.1f%% goodput)" % (100 * (cell['goodput'] / previous['goodput'] - 1))
+    print(line, flush=True)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    grid = list(itertools.product(args.segment_size or [100, MAX_SEGMENT_SIZE], args.payload or [1000, 100000],
+                                  args.drop_rate or [0.0, 0.1], args.max_delay or ['0', '5ms']))
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = {CellKey(cell): cell for cell in json.load(file)['results']}
+
+    # the server gets its own process, so that it does not share the interpreter lock with the client and router
+    server = multiprocessing.Process(target=RunEchoServer, args=(args.server_port,), daemon=True)
+    server.start()
+    time.sleep(0.5)
+    results = []
+    for segmentSize, payload, dropRate, maxDelay in grid:
+        results.append(MeasureTransport(args, segmentSize, payload, dropRate, maxDelay))
+        PrintCell(results[-1], baseline)
+    server.terminate()
+
+    if args.http:
+        with tempfile.TemporaryDirectory() as directory:
+            for payload in sorted(set(payload for segmentSize, payload, dropRate, maxDelay in grid)):
+                with open(os.path.join(directory, 'payload-%d.txt' % payload), 'w') as file:
+                    file.write(''.join(chr(65 + i % 26) for i in range(payload)))
+            httpfs = subprocess.Popen([sys.executable, 'httpfs.py', '-p', str(args.server_port + 1),
+                                       '-d', directory + os.sep], stdout=subprocess.DEVNULL,
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+            time.sleep(1)
+            try:
+                for segmentSize, payload, dropRate, maxDelay in grid:
+                    results.append(MeasureHttp(args, directory, segmentSize, payload, dropRate, maxDelay))
+                    PrintCell(results[-1], baseline)
+            finally:
+                httpfs.kill()
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': Commit(), 'python': sys.version.split()[0],
+                       'repeat': args.repeat, 'seed': args.seed, 'results': results}, file, indent=2)
+    # the client threads of timed out transfers are daemons and die here
+    sys.exit(0)
@@ -1,29 +1,65 @@
 import argparse
+import json
+import os
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
+from ConnectionPool import ConnectionPool
+from HTTPParser import HTTPParser
 from ReliableClient import ReliableClient
+from ReliableTransport import MAX_SEGMENT_SIZE, StreamReader
 
 # command line arguments
 parser = argparse.ArgumentParser(description='Implements HTTP get/post request')
 # positional arguments
-parser.add_argument('type', type=str, choices=['get', 'post'], help='type of the request')
-parser.add_argument('URL', type=str)
+parser.add_argument('type', type=str, choices=['get', 'post', 'batch'],
+                    help='type of the request, batch runs the requests listed in the file(s) given as URL')
+parser.add_argument('URL', type=str, nargs='+', help='URL(s), the ones on the same server share one connection')
 # optional arguments
 parser.add_argument('-H', help='HTTP header', action='append')
 parser.add_argument('-d', '--inline_data', help='HTTP body')
 parser.add_argument('-f', '--file', help='HTTP header from file')
 parser.add_argument('-o', help='Write response body to file')
 parser.add_argument('-l', type=int, help='Maximum number of redirects')
+parser.add_argument('--mss', type=int, help='Largest segment size to offer, default: negotiated with the server')
+parser.add_argument('-P', '--pipeline', action='store_true',
+                    help='Send all GET requests of a connection before reading the responses')
+parser.add_argument('-c', '--concurrency', type=int, default=8, help='Requests running at once in batch mode')
+parser.add_argument('--pool', type=int, default=4, help='Maximum number of connections per server')
+parser.add_argument('--fast-open', action='store_true',
+                    help='One connection per request, sent with the SYN when it fits (httpfs --fast-open)')
+parser.add_argument('--router-port', type=int, default=3000, help='Port of the router on this host')
+parser.add_argument('--parallel', type=int,
+                    help='Download the file of a GET into -o as byte ranges over this many connections, '
+                         'an interrupted download resumes when run again')
 # mutually exclusive argument
 group = parser.add_mutually_exclusive_group()
 group.add_argument('-v', action='store_true', help='Verbose')
 args = parser.parse_args()
+if args.mss is not None and not 0 < args.mss <= MAX_SEGMENT_SIZE:
+    # a larger segment does not fit in a packet
+    parser.error('--mss has to be between 1 and %d' % MAX_SEGMENT_SIZE)
+if args.parallel and (args.type != 'get' or not args.o or len(args.URL) != 1):
+    parser.error('--parallel downloads the file of one GET URL into -o')
+
+# bytes per range of a parallel download, also what is fetched again of an interrupted one
+PART_SIZE = 64 * 1024
+# a range is tried this many more times before the download stops, to be resumed later
+RANGE_RETRIES = 2
+
+# kept-alive connections, reused by every request to the same server
+pool = ConnectionPool('localhost', args.router_port, max(args.pool, args.parallel or 0), args.mss)
+# connections opened by FastOpenExchange, outside the pool
+fastOpened = 0
+fastOpenedLock = threading.Lock()
 
 
 def CreateRequest(type, pathandQuery, hostname, headers, body):
     # get request
     if type == 'get':
-        request = "GET " + pathandQuery + " HTTP/1.1r\r\nHost:" + hostname
+        request = "GET " + pathandQuery + " HTTP/1.1\r\nHost: " + hostname
 
         # adding header
         if headers is not None:
@@ -35,34 +71,91 @@ def CreateRequest(type, pathandQuery, hostname, headers, body):
 
     # post request
     if type == 'post':
-        request = "POST " + pathandQuery + " HTTP/1.1\r\nHost:" + hostname
+        request = "POST " + pathandQuery + " HTTP/1.1\r\nHost: " + hostname
 
-        # adding header
+        # adding header, Content-Length is always the real one since it frames the body on the connection
         if headers is not None:
-            for item in args.H:
-                request += "\r\n" + item
+            for item in headers:
+                if item.partition(":")[0].strip().lower() != 'content-length':
+                    request += "\r\n" + item
+        request += "\r\nContent-Length: " + str(len(body.encode()) if body else 0)
 
         # two new lines before the body
         request += "\r\n\r\n"
 
         # adding body from command
         if body:
-            request += body + "\r\n\r\n"
+            request += body
 
     return request
 
 
-def SendData(hostName, port, data):
+def ReadResponse(reader, outputFile=None):
+    """
+    ReadResponse returns the next response of the connection as HTTPMessage, it ends after its headers
+    plus Content-Length bytes of body and the connection stays open.
+    """
+    if outputFile is None:
+        parser = HTTPParser(isResponse=True)
+        complete = parser.ReadFrom(reader)
+    else:
+        # the body is appended to the output file chunk by chunk as it arrives, not after the transfer
+        with open(outputFile, 'ab') as file:
+            parser = HTTPParser(isResponse=True, bodySink=file.write)
+            complete = parser.ReadFrom(reader)
+            file.write(b'\n')
+    if not complete:
+        raise ConnectionError("connection closed before the response")
+    return parser.message
+
+
+def FastOpenExchange(hostName, port, data, outputFile=None):
+    # the request closes our side of its own connection, so it rides on the SYN and a small response on the FIN
+    global fastOpened
+    with fastOpenedLock:
+        fastOpened += 1
+    client = ReliableClient('localhost', args.router_port, hostName, port, args.mss, fastOpen=True)
+    try:
+        client.SendRequest(data)
+        receivedData = ReadResponse(StreamReader(client.ReceiveStream()), outputFile)
+    except Exception:
+        client.ReleaseSocket()
+        raise
+    # wait for the server's FIN, so that it gets its FINACK
+    client.Close()
+    return receivedData
+
+
+def Exchange(hostName, port, data, outputFile=None):
+    if args.fast_open:
+        return FastOpenExchange(hostName, port, data, outputFile)
+    connection = pool.Acquire(hostName, port)
     try:
-        reliclinet = ReliableClient('localhost', 3000, hostName, port, 3)
-        receivedData = reliclinet.Transfer(data)
-        return receivedData
+        connection.client.Send(data)
+        receivedData = ReadResponse(connection.reader, outputFile)
+    except ConnectionError:
+        pool.Release(connection, reusable=False)
+        # the server may close a kept-alive connection while it idles, a GET is simply repeated on another one
+        if connection.uses > 1 and data.startswith('GET '):
+            return Exchange(hostName, port, data, outputFile)
+        raise
+    except Exception:
+        pool.Release(connection, reusable=False)
+        raise
+
+    # either side asked to close, the next request opens a new connection
+    requestHeader = data.split("\r\n\r\n")[0].splitlines()[1:]
+    pool.Release(connection, (HeaderValue(requestHeader, 'Connection') or '').lower() != 'close'
+                 and not receivedData.WantsClose())
+    return receivedData
+
+
+def SendData(hostName, port, data, outputFile=None):
+    try:
+        return Exchange(hostName, port, data, outputFile)
 
     except Exception as e:
         print(e)
-    #
-    # finally:
-    #     mySock.close()
 
 
 def ReadFromFile(fileAddress):
@@ -91,80 +184,54 @@ def WritetoFile(fileAddress, content: str, mode: str = "w"):
         print(e)
 
 
-def ParseResponse(response):
-    lines = response.splitlines()
-    firstLineParts = lines[0].split(" ")
-    statusLine = lines[0]
-    httpVersion = firstLineParts[0]
-    code = firstLineParts[1]
-    status = firstLineParts[2]
-    header = response.split("\r\n\r\n")[0].splitlines()[1:]
-    # check if it does not have a body in response
-    body = response.split("\r\n\r\n")[1] if len(response.split("\r\n\r\n")) > 1 else None
-    responseDict = {'StatusLine': statusLine, 'HTTPVersion': httpVersion, 'Code': code, 'Status': status,
-                    'Header': header, 'Body': body}
-    return responseDict
-
-
 def PrintResponse(response):
-    responseParameters = ParseResponse(response)
     print("\n****Response:****")
-    print("Status Line: " + responseParameters["StatusLine"])
-    print("Status: " + responseParameters["Status"])
-    print("Code: " + responseParameters["Code"])
+    print("Status Line: " + response.startLine)
+    print("Status: " + response.status)
+    print("Code: " + str(response.code))
     print("Header(s): ")
-    print(responseParameters["Header"])
-    print("Body: " + responseParameters["Body"]) if responseParameters["Body"] is not None else print(
-        "No body received!")
+    print(response.headerLines)
+    print("Body: " + response.BodyText())
 
 def PrintBody(response):
     print("\n****Response:****")
-    print(ParseResponse(response)["Body"])
-
-def ParseHeaderListtoDict(headerList):
-    dict = {}
-    try:
-        for item in headerList:
-            dict[item.split(": ", 1)[0]] = item.split(": ", 1)[1]
-
-        return dict
-    except Exception as e:
-        print(e)
+    print(response.BodyText())
 
 
-# reformatting the command type
-args.type = args.type.lower()
-
-# extracting parts of the link
-urlparser = urlparse(args.URL)
-hostname = urlparser.hostname
-port = urlparser.port
-port = 80 if port is None else port
-pathandQuery = urlparser.path + ('?' + urlparser.query if urlparser.query else "")
+def HeaderValue(headerList, name):
+    # header names are case-insensitive and the space after the colon is optional
+    for item in headerList:
+        key, _, value = item.partition(":")
+        if key.strip().lower() == name.lower():
+            return value.strip()
+    return None
 
-# empty the output file
-if args.o:
-    WritetoFile(args.o, "")
 
-# verbose
-if args.v:
-    print("Hostname: " + hostname)
-    print("Path and query: " + pathandQuery)
-    print("Header(s):")
-    print(args.H)
+def ParseURL(url):
+    # extracting parts of the link
+    urlparser = urlparse(url)
+    hostname = urlparser.hostname
+    port = urlparser.port
+    port = 80 if port is None else port
+    pathandQuery = urlparser.path + ('?' + urlparser.query if urlparser.query else "")
+    return hostname, port, pathandQuery, urlparser.query
 
-# executing GET command
-if args.type == 'get':
 
-    request = CreateRequest(args.type, pathandQuery, hostname, args.H, None)
+def Fetch(hostname, port, pathandQuery, query, body, response=None):
+    """
+    Fetch runs one request and follows its redirects on the same kept-alive connection.
+    response is the already received answer of a pipelined request.
+    """
+    request = CreateRequest(args.type, pathandQuery, hostname, args.H, body)
 
     # number of redirects
     redirectNum = args.l if args.l else 1
 
     # i range should have +1 because first loop only counts for the first request not the redirect
     for i in range(redirectNum + 1):
-        response = SendData(hostname, port, request)
-        responseCode = int(ParseResponse(response)["Code"])
+        if response is None:
+            response = SendData(hostname, port, request, args.o)
+        responseCode = response.code
 
         # verbose
         if args.v:
@@ -174,51 +241,239 @@ if args.type == 'get':
         elif not args.v and responseCode == 200:
             PrintBody(response)
 
-        # write response body to file
-        if args.o:
-            WritetoFile(args.o, ParseResponse(response)["Body"] + "\n", "a")
-
         # breaking in last redirect or creating new request
         if responseCode != 301 and responseCode != 302:
             break
         else:
-            responseHeader = ParseResponse(response)["Header"]
-            newPath = ParseHeaderListtoDict(responseHeader)["Location"]
-            pathandQuery = newPath + ('?' + urlparser.query if urlparser.query else "")
-            request = CreateRequest(args.type, pathandQuery, hostname, args.H, None)
+            newPath = response.Header('Location')
+            pathandQuery = newPath + ('?' + query if query else "")
+            request = CreateRequest(args.type, pathandQuery, hostname, args.H, body)
+            response = None
 
 
-# executing POST command
-elif args.type == 'post':
+def FetchRange(hostname, port, pathandQuery, first, last, etag=None):
+    headers = (args.H or []) + ['Range: bytes=%d-%d' % (first, last)]
+    if etag is not None:
+        # a file changed since the other ranges were fetched comes back whole (200) instead of mixed in
+        headers.append('If-Range: ' + etag)
+    return Exchange(hostname, port, CreateRequest('get', pathandQuery, hostname, headers, None))
 
-    requestBody = args.inline_data if args.inline_data else ReadFromFile(args.file) if args.file else ""
-    request = CreateRequest(args.type, pathandQuery, hostname, args.H, requestBody)
 
-    # number of redirects
-    redirectNum = args.l if args.l else 1
+def ParseContentRange(value):
+    # "bytes first-last/size" of a 206 response
+    unit, _, spec = (value or '').partition(' ')
+    span, _, size = spec.partition('/')
+    first, _, last = span.partition('-')
+    return int(first), int(last), int(size)
 
-    for i in range(redirectNum + 1):
-        response = SendData(hostname, port, request)
-        responseCode = int(ParseResponse(response)["Code"])
 
-        # verbose
-        if args.v:
-            print("\n****Full request:****\n" + request)
-            PrintResponse(response)
-        # only shows the last page after redirects body
-        elif not args.v and responseCode == 200:
-            PrintBody(response)
+def ReadJournal(journalFile, url):
+    """
+    ReadJournal returns the header of an interrupted download of url and the set of its finished (first, last)
+    ranges, or None. The journal is the JSON header line followed by a "first last" line per finished range.
+    """
+    try:
+        with open(journalFile) as file:
+            lines = file.read().split('\n')
+        header = json.loads(lines[0])
+    except (OSError, ValueError):
+        return None
+    if header.get('url') != url or header.get('partSize') != PART_SIZE:
+        return None
+    # the last line is cut off, or empty, if the download was interrupted while writing it
+    done = set()
+    for line in lines[1:-1]:
+        first, _, last = line.partition(' ')
+        done.add((int(first), int(last)))
+    return header, done
+
+
+def ParallelDownload(hostname, port, pathandQuery, url, outputFile):
+    """
+    ParallelDownload fetches the file as PART_SIZE byte ranges over args.parallel connections at once
+    and writes each at its offset of outputFile. The finished ranges are journaled next to it, so a download that
+    is interrupted or loses ranges continues with the missing ones when run again, unless the file changed.
+    """
+    journalFile = outputFile + '.part'
+    start = time.time()
+    # the first range also tells the size and version of the file
+    response = FetchRange(hostname, port, pathandQuery, 0, PART_SIZE - 1)
+    if response.code in (200, 416):
+        # a server without ranges sends the whole file, an empty file has no range to send
+        with open(outputFile, 'wb') as file:
+            file.write(response.body)
+        if os.path.exists(journalFile):
+            os.remove(journalFile)
+        print("Downloaded %d bytes into %s in %.3fs" % (len(response.body), outputFile, time.time() - start))
+        return
+    if response.code != 206:
+        PrintResponse(response)
+        return
+    first, last, size = ParseContentRange(response.Header('Content-Range'))
+    etag = response.Header('ETag')
+    parts = [(offset, min(offset + PART_SIZE, size) - 1) for offset in range(0, size, PART_SIZE)]
+
+    journal = ReadJournal(journalFile, url)
+    done = set()
+    if journal is not None and journal[0].get('etag') == etag and journal[0].get('size') == size \
+            and os.path.exists(outputFile):
+        done = journal[1]
+    else:
+        # nothing to resume: a fresh output file of the final size and a fresh journal
+        with open(outputFile, 'wb') as file:
+            file.truncate(size)
+        with open(journalFile, 'w') as file:
+            file.write(json.dumps({'url': url, 'etag': etag, 'size': size, 'partSize': PART_SIZE}) + '\n')
+    resumed = len(done)
+
+    lock = threading.Lock()
+    with open(outputFile, 'r+b') as file, open(journalFile, 'a') as journalWriter:
+        def Store(part, body):
+            with lock:
+                file.seek(part[0])
+                file.write(body)
+                # the range is journaled only once its bytes are written
+                file.flush()
+                journalWriter.write('%d %d\n' % part)
+                journalWriter.flush()
+                done.add(part)
+
+        def Download(part):
+            for attempt in range(RANGE_RETRIES + 1):
+                try:
+                    response = FetchRange(hostname, port, pathandQuery, part[0], part[1], etag)
+                    if response.code != 206 or ParseContentRange(response.Header('Content-Range')) != part + (size,):
+                        raise ConnectionError("unexpected response to range %d-%d: %s" % (
+                            part[0], part[1], response.startLine))
+                    Store(part, response.body)
+                    return
+                except (ConnectionError, ValueError) as e:
+                    print(e)
+
+        if parts[0] not in done and (first, last) == parts[0]:
+            Store(parts[0], response.body)
+        with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+            list(executor.map(Download, [part for part in parts if part not in done]))
+
+    missing = len(parts) - len(done)
+    if missing:
+        print("%d of %d ranges missing, run again to resume the download" % (missing, len(parts)))
+        return
+    os.remove(journalFile)
+    print("Downloaded %d bytes into %s in %.3fs over %d connections, %d of %d ranges resumed" % (
+        size, outputFile, time.time() - start, args.parallel, resumed, len(parts)))
+
+
+def ReadBatch(fileAddress):
+    """
+    ReadBatch returns the requests of a batch file, one per line, either as
+    METHOD URL [BODY] or as a JSON object {"method": ..., "url": ..., "body": ..., "headers": [...]}.
+    Empty lines and lines starting with # are skipped.
+    """
+    requests = []
+    with open(fileAddress, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                item = json.loads(line)
+            else:
+                parts = line.split(None, 2)
+                item = {'method': parts[0], 'url': parts[1], 'body': parts[2] if len(parts) > 2 else None}
+            requests.append({'method': item.get('method', 'get').lower(), 'url': item['url'],
+                             'body': item.get('body'), 'headers': item.get('headers', args.H)})
+    return requests
+
+
+def RunBatchRequest(index, item):
+    hostname, port, pathandQuery, query = ParseURL(item['url'])
+    request = CreateRequest(item['method'], pathandQuery, hostname, item['headers'], item['body'])
+    result = {'index': index, 'method': item['method'].upper(), 'url': item['url'], 'code': None, 'bytes': 0}
+    start = time.time()
+    try:
+        response = Exchange(hostname, port, request)
+        result['code'] = response.code
+        result['bytes'] = response.Size()
+    except Exception as e:
+        result['error'] = str(e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def RunBatch(fileAddresses):
+    requests = [item for fileAddress in fileAddresses for item in ReadBatch(fileAddress)]
+    start = time.time()
+    # the executor bounds the requests in progress, the pool the connections per server
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(lambda item: RunBatchRequest(*item), enumerate(requests)))
+    elapsed = time.time() - start
+
+    print("\n****Batch results:****")
+    for result in results:
+        status = result['code'] if result['code'] is not None else 'error: ' + result['error']
+        print("#%d %s %s -> %s, %d bytes, %.3fs" % (result['index'], result['method'], result['url'], status,
+                                                   result['bytes'], result['seconds']))
+    succeeded = sum(1 for result in results if result['code'] is not None and result['code'] < 400)
+    totalBytes = sum(result['bytes'] for result in results)
+    print("%d requests (%d succeeded) in %.3fs over %d connections: %.1f requests/s, %.0f bytes/s" % (
+        len(results), succeeded, elapsed, pool.opened + fastOpened, len(results) / elapsed if elapsed else 0,
+        totalBytes / elapsed if elapsed else 0))
 
-        # write response body to file
-        if args.o:
-            WritetoFile(args.o, ParseResponse(response)["Body"] + "\n", "a")
 
-        # breaking in last redirect or creating new request
-        if responseCode != 301 and responseCode != 302:
-            break
-        else:
-            responseHeader = ParseResponse(response)["Header"]
-            newPath = ParseHeaderListtoDict(responseHeader)["Location"]
-            pathandQuery = newPath + ('?' + urlparser.query if urlparser.query else "")
-            request = CreateRequest(args.type, pathandQuery, hostname, args.H, requestBody)
+# reformatting the command type
+args.type = args.type.lower()
+
+if args.type == 'batch':
+    RunBatch(args.URL)
+    pool.Close()
+    raise SystemExit(0)
+
+targets = [ParseURL(url) for url in args.URL]
+
+# empty the output file, a parallel download resumes what it holds
+if args.o and not args.parallel:
+    WritetoFile(args.o, "")
+
+# verbose
+if args.v:
+    for hostname, port, pathandQuery, query in targets:
+        print("Hostname: " + hostname)
+        print("Path and query: " + pathandQuery)
+    print("Header(s):")
+    print(args.H)
+
+# executing GET command
+if args.type == 'get' and args.parallel:
+    hostname, port, pathandQuery, query = targets[0]
+    ParallelDownload(hostname, port, pathandQuery, args.URL[0], args.o)
+
+elif args.type == 'get':
+    responses = [None] * len(targets)
+
+    if args.pipeline and not args.fast_open:
+        # all requests of a connection go out back to back, the responses come back in the same order
+        pipelined = {}
+        for index, (hostname, port, pathandQuery, query) in enumerate(targets):
+            pipelined.setdefault((hostname, port), []).append(
+                (index, CreateRequest(args.type, pathandQuery, hostname, args.H, None)))
+        for (hostname, port), requests in pipelined.items():
+            connection = pool.Acquire(hostname, port)
+            connection.client.Send([request for index, request in requests])
+            for index, request in requests:
+                responses[index] = ReadResponse(connection.reader, args.o)
+            pool.Release(connection)
+
+    for (hostname, port, pathandQuery, query), response in zip(targets, responses):
+        Fetch(hostname, port, pathandQuery, query, None, response)
+
+
+# executing POST command
+elif args.type == 'post':
+
+    requestBody = args.inline_data if args.inline_data else ReadFromFile(args.file) if args.file else ""
+
+    for hostname, port, pathandQuery, query in targets:
+        Fetch(hostname, port, pathandQuery, query, requestBody)
 
+pool.Close()
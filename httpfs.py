@@ -1,52 +1,71 @@
 import argparse
-import socket
-import threading
+import json
+import time
 from datetime import datetime
 from babel.dates import format_datetime
 import os
 import pathlib
-from ReliableServer import ReliableServer
+from HTTPParser import HTTPParser
+from ReliableServer import HANDLER_QUEUE, HANDLERS, ReliableServer, ServerConnection
+from ReliableTransport import MAX_SEGMENT_SIZE, SegmentedPayload, StreamReader
+from ResponseCache import ResponseCache
+from ShardedServer import ShardedServer
+
+# bytes read from disk at a time while a file is streamed
+FILE_BLOCK_SIZE = 64 * 1024
+
+# reserved path serving the transport and cache statistics instead of a file
+STATS_PATH = '/_stats'
+
+# seconds a kept-alive connection may idle on a handler while other connections wait for one
+KEEP_ALIVE_IDLE = 0.2
+# seconds it may idle at all, well below the transport's CLIENT_IDLE so that a live client gets its FIN
+KEEP_ALIVE_TIMEOUT = 5.0
+
+# bytes of request body the server holds, e.g. of an upload, a request announcing more gets 413
+MAX_BODY_SIZE = 64 * 1024 * 1024
 
 # command line arguments
 parser = argparse.ArgumentParser(description='Implements HTTP get/post request')
 # optional arguments
 parser.add_argument('-p', '--port', type=int, help='Port')
 parser.add_argument('-d', '--dir', type=str, help='Directory path')
+parser.add_argument('--mss', type=int, help='Largest segment size to accept, default: as large as a packet allows')
+parser.add_argument('--fast-open', action='store_true',
+                    help='Accept requests sent with the SYN, small responses then go out with the FIN')
+parser.add_argument('--cache-size', type=int, default=16 * 1024 * 1024,
+                    help='Bytes of rendered responses kept in memory (per worker), 0 disables the cache')
+parser.add_argument('-w', '--workers', type=int, default=1,
+                    help='Processes serving the port, each connection is handled by one of them')
+parser.add_argument('--handlers', type=int, default=HANDLERS, help='Connections served at once (per worker)')
+parser.add_argument('--queue', type=int, default=HANDLER_QUEUE,
+                    help='Connections waiting for a handler (per worker), beyond them --overload applies')
+parser.add_argument('--overload', choices=['refuse', 'shed'], default='refuse',
+                    help='refuse: leave the SYN of new connections unanswered until there is room, '
+                         'shed: answer them with 503 Service Unavailable')
 # mutually exclusive argument
 group = parser.add_mutually_exclusive_group()
 group.add_argument('-v', action='store_true', help='Verbose')
 args = parser.parse_args()
+if args.mss is not None and not 0 < args.mss <= MAX_SEGMENT_SIZE:
+    # a larger segment does not fit in a packet
+    parser.error('--mss has to be between 1 and %d' % MAX_SEGMENT_SIZE)
 
 
 def Run_TCP_listener(port):
-    reliserver = ReliableServer(port, 3)
-    reliserver.RunServer(HTTP_file_handler)
-
-
-def ParseRequest(request):
-    lines = request.splitlines()
-    firstLineParts = lines[0].split(" ")
-    requestLine = lines[0]
-    type = firstLineParts[0]
-    path = firstLineParts[1]
-    httpVersion = firstLineParts[2]
-    header = request.split("\r\n\r\n")[0].splitlines()[1:]
-    # check if it does not have a body in response
-    body = request.split("\r\n\r\n")[1] if len(request.split("\r\n\r\n")) > 1 else None
-    responseDict = {'RequestLine': requestLine, 'HTTPVersion': httpVersion, 'Type': type, 'Path': path,
-                    'Header': header, 'Body': body}
-    return responseDict
-
-
-def ParseHeaderListtoDict(headerList):
-    dict = {}
-    try:
-        for item in headerList:
-            dict[item.split(": ", 1)[0]] = item.split(": ", 1)[1]
-
-        return dict
-    except Exception as e:
-        print(e)
+    global reliserver
+    # assigned before RunServer forks the workers, their handlers reach the server through this global
+    if args.workers > 1:
+        reliserver = ShardedServer(port, args.workers, args.mss, fastOpen=args.fast_open, handlers=args.handlers,
+                                   queueSize=args.queue, overload=args.overload)
+        reliserver.RunServer(HTTP_file_handler, streaming=True, workerStats=responseCache.Stats,
+                             overloadHandler=HTTP_overload_handler)
+    else:
+        reliserver = ReliableServer(port, args.mss, fastOpen=args.fast_open, handlers=args.handlers,
+                                    queueSize=args.queue, overload=args.overload)
+        # streaming: the handler reads the requests of a kept-alive connection one after the other
+        reliserver.RunServer(HTTP_file_handler, streaming=True, overloadHandler=HTTP_overload_handler)
+    return reliserver
 
 
 def HTTPDateTime():
@@ -55,25 +74,71 @@ def HTTPDateTime():
     return format_datetime(now, format, locale='en') + ' GMT'
 
 
-def Transfer(socketInstance: ReliableServer, data):
-    socketInstance.Transfer(data)
+def Transfer(socketInstance: ServerConnection, data):
+    # the connection stays open for the next request, HTTP_file_handler closes it
+    socketInstance.Send(data)
 
 
 def SendUnauthorized(socketInstance):
-    response = 'HTTP/1.0 403 Forbidden\r\nDate:' + HTTPDateTime() + '\r\n\r\n'
+    response = 'HTTP/1.1 403 Forbidden\r\nDate:' + HTTPDateTime() + '\r\nContent-Length: 0\r\n\r\n'
     if args.v:
         print("\n****Sent Response:****\n" + response)
     Transfer(socketInstance, response)
 
 
-def SendOkResponse(socketInstance, body=None, header=None):
-    response = 'HTTP/1.0 200 OK\r\n'
+def OkResponse(body=None, header=None):
+    response = 'HTTP/1.1 200 OK\r\n'
 
     if header is not None:
         response += header + '\r\n'
-    if body is not None:
-        response += '\r\n' + body
-    response += '\r\n'
+    # the client finds the end of the response by its length
+    body = body if body is not None else ''
+    response += 'Content-Length: ' + str(len(body.encode())) + '\r\n'
+    response += '\r\n' + body
+    return response
+
+
+def SendOkResponse(socketInstance, body=None, header=None):
+    response = OkResponse(body, header)
+
+    if args.v:
+        print("\n****Sent Response:****\n" + response)
+
+    Transfer(socketInstance, response)
+
+
+def SendDirectoryList(socketInstance):
+    # the listing only changes when a file is created or removed, which updates the directory mtime
+    validator = os.stat(crntdir).st_mtime_ns
+    response = responseCache.Get('/', validator)
+    if response is None:
+        response = SegmentedPayload(OkResponse(FileList2Body(GetDirectoryFileList(crntdir))))
+        responseCache.Put('/', validator, response)
+
+    if args.v:
+        print("\n****Sent Response:****\n" + response.data.decode())
+
+    Transfer(socketInstance, response)
+
+
+def SendStats(socketInstance):
+    # never cached, it is live data: open connections show their windows and RTT while they transfer
+    try:
+        transport = reliserver.GetStats()
+        cache = responseCache.Stats()
+        if 'workers' in transport:
+            # every worker has its own cache, the numbers of the others are as of their last publication
+            cache = {}
+            for worker in transport['workers']:
+                for key, value in worker['application'].items():
+                    cache[key] = cache.get(key, 0) + value
+        body = json.dumps({'transport': transport, 'cache': cache}, indent=2)
+    except Exception as e:
+        # e.g. the stats manager of the workers is gone, the client still gets an answer
+        print(e)
+        SendInternalServerError(socketInstance)
+        return
+    response = OkResponse(body, 'Content-Type: application/json')
 
     if args.v:
         print("\n****Sent Response:****\n" + response)
@@ -81,15 +146,172 @@ def SendOkResponse(socketInstance, body=None, header=None):
     Transfer(socketInstance, response)
 
 
+def FileETag(stat):
+    # changes with every write, so that a resumed download does not mix parts of two versions of the file
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+def FileResponseHeader(size, etag):
+    header = 'Content-Type: text/html; charset=utf-8\r\nAccept-Ranges: bytes\r\nETag: ' + etag
+    header += '\r\nContent-Length: ' + str(size)
+    return 'HTTP/1.1 200 OK\r\n' + header + '\r\n\r\n'
+
+
+def ParseRange(value, size):
+    """
+    ParseRange returns (first, last) of the single "bytes=" range value of a file of size bytes, clamped to the file,
+    () if the range lies beyond the file, and None for a value that is ignored: another unit, several ranges, malformed.
+    """
+    unit, _, spec = value.partition('=')
+    first, dash, last = spec.strip().partition('-')
+    if unit.strip().lower() != 'bytes' or ',' in spec or not dash:
+        return None
+    try:
+        if not first:
+            # suffix range: the last bytes of the file
+            suffix = int(last)
+            if suffix < 0:
+                return None
+            return (max(size - suffix, 0), size - 1) if suffix and size else ()
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        return None
+    if first < 0 or last is not None and last < first:
+        return None
+    if first >= size:
+        return ()
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+def CachedFileResponse(path, fileAddress, stat):
+    """
+    CachedFileResponse returns the whole 200 response of the file as SegmentedPayload, from the cache or read
+    and cached now, or None if it does not fit in the cache and is streamed from disk instead.
+    """
+    validator = (stat.st_mtime_ns, stat.st_size)
+    response = responseCache.Get(path, validator)
+    if response is None and responseCache.Fits(len(FileResponseHeader(stat.st_size, FileETag(stat))) + stat.st_size):
+        with open(fileAddress, 'rb') as file:
+            body = file.read()
+        # the header follows what was read, in case the file changed since the stat
+        header = FileResponseHeader(len(body), FileETag(stat))
+        # cached pre-segmented, so serving it again skips encoding and segmentation
+        response = SegmentedPayload(header.encode() + body)
+        if len(body) == stat.st_size:
+            responseCache.Put(path, validator, response)
+    return response
+
+
+def SendFileResponse(socketInstance, request, path, fileAddress):
+    stat = os.stat(fileAddress)
+    etag = FileETag(stat)
+    rangeHeader = request.Header('Range')
+    # with If-Range the range only applies to the version the client has the other parts of, else the whole file
+    if rangeHeader is not None and request.Header('If-Range') in (None, etag):
+        byteRange = ParseRange(rangeHeader, stat.st_size)
+        if byteRange == ():
+            SendRangeNotSatisfiable(socketInstance, stat.st_size)
+            return
+        if byteRange is not None:
+            SendFileRange(socketInstance, path, fileAddress, stat, byteRange)
+            return
+
+    response = CachedFileResponse(path, fileAddress, stat)
+    header = FileResponseHeader(stat.st_size, etag)
+
+    if args.v:
+        print("\n****Sent Response:****\n" + header + '<' + fileAddress + '>')
+
+    if response is not None:
+        Transfer(socketInstance, response)
+        return
+
+    # too large for the cache: the body is streamed from disk block by block,
+    # only the segments in flight are held in memory
+    def Stream():
+        yield header.encode()
+        with open(fileAddress, 'rb') as file:
+            yield from iter(lambda: file.read(FILE_BLOCK_SIZE), b'')
+
+    Transfer(socketInstance, Stream())
+
+
+def SendFileRange(socketInstance, path, fileAddress, stat, byteRange):
+    first, last = byteRange
+    length = last - first + 1
+    header = 'HTTP/1.1 206 Partial Content\r\nContent-Type: text/html; charset=utf-8\r\nAccept-Ranges: bytes\r\n'
+    header += 'ETag: %s\r\nContent-Range: bytes %d-%d/%d\r\nContent-Length: %d\r\n\r\n' % (
+        FileETag(stat), first, last, stat.st_size, length)
+
+    if args.v:
+        print("\n****Sent Response:****\n" + header + '<' + fileAddress + '>')
+
+    # the parts of a parallel download all come from one read of the file, sliced out of its cached response
+    response = CachedFileResponse(path, fileAddress, stat)
+    if response is not None:
+        bodyStart = len(response.data) - stat.st_size
+        if response.data[bodyStart - 4:bodyStart] == b'\r\n\r\n':
+            body = memoryview(response.data)[bodyStart + first:bodyStart + last + 1]
+            Transfer(socketInstance, [header.encode(), body])
+            return
+
+    def Stream():
+        yield header.encode()
+        with open(fileAddress, 'rb') as file:
+            file.seek(first)
+            remaining = length
+            while remaining > 0:
+                block = file.read(min(FILE_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                yield block
+
+    Transfer(socketInstance, Stream())
+
+
+def SendRangeNotSatisfiable(socketInstance, size):
+    response = 'HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */' + str(size)
+    response += '\r\nContent-Length: 0\r\n\r\n'
+    if args.v:
+        print("\n****Sent Response:****\n" + response)
+    Transfer(socketInstance, response)
+
+
 def SendNotFound(socketInstance):
-    response = 'HTTP/1.0 404 NotFound\r\n\r\n'
+    response = 'HTTP/1.1 404 NotFound\r\nContent-Length: 0\r\n\r\n'
+    if args.v:
+        print("\n****Sent Response:****\n" + response)
+    Transfer(socketInstance, response)
+
+
+def SendBadRequest(socketInstance):
+    # where the next request would start is unknown, the connection is closed after it
+    response = 'HTTP/1.1 400 Bad Request\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
+    if args.v:
+        print("\n****Sent Response:****\n" + response)
+    Transfer(socketInstance, response)
+
+
+def SendPayloadTooLarge(socketInstance):
+    # the body is neither read nor skipped, the connection is closed after it
+    response = 'HTTP/1.1 413 Payload Too Large\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
+    if args.v:
+        print("\n****Sent Response:****\n" + response)
+    Transfer(socketInstance, response)
+
+
+def SendServiceUnavailable(socketInstance):
+    # the client closes, and may come back after Retry-After seconds
+    response = 'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nConnection: close\r\nContent-Length: 0\r\n\r\n'
     if args.v:
         print("\n****Sent Response:****\n" + response)
     Transfer(socketInstance, response)
 
 
 def SendInternalServerError(socketInstance):
-    response = 'HTTP/1.0 500 InternalServerError\r\n\r\n'
+    response = 'HTTP/1.1 500 InternalServerError\r\nContent-Length: 0\r\n\r\n'
     if args.v:
         print("\n****Sent Response:****\n" + response)
     Transfer(socketInstance, response)
@@ -108,75 +330,112 @@ def GetDirectoryFileList(dir):
     return [f for f in os.listdir(dir) if os.path.isfile(os.path.join(dir, f))]
 
 
-def ReadFromFile(fileAddress):
+def WritetoFile(fileAddress, content: bytes, mode: str = "wb"):
     try:
-        with open(fileAddress, 'r') as file:
-            lines = file.readlines()
-            file.close()
-            returnText = ''
-            for index, item in enumerate(lines):
-                returnText += item
-                # if it is not the last item in the list
-                if index != len(lines) - 1:
-                    returnText += '\n'
-            return returnText
+        with open(fileAddress, mode) as file:
+            file.write(content)
 
     except Exception as e:
         print(e)
+        raise Exception("WriteError")
 
 
-def WritetoFile(fileAddress, content: str, mode: str = "w"):
+def HTTP_file_handler(stream, socketInstance):
+    reader = StreamReader(stream)
+    idleSince = time.time()
     try:
-        with open(fileAddress, mode) as file:
-            file.write(content)
-
-    except Exception as e:
+        # keep-alive: serve requests until the client closes its side or asks to close
+        while True:
+            # an idle connection gives its handler up to the waiting ones, and after KEEP_ALIVE_TIMEOUT anyway;
+            # the client opens a new connection
+            if not reader.buffer and not socketInstance.WaitForData(KEEP_ALIVE_IDLE):
+                if socketInstance.pool.Contended() or time.time() - idleSince >= KEEP_ALIVE_TIMEOUT:
+                    break
+                continue
+            # the head decides the response, the body is read only by the requests that need it
+            parser = HTTPParser()
+            try:
+                if not parser.ReadFrom(reader, headOnly=True):
+                    break
+            except ValueError as e:
+                print(e)
+                SendBadRequest(socketInstance)
+                break
+            if parser.message.contentLength > MAX_BODY_SIZE:
+                SendPayloadTooLarge(socketInstance)
+                break
+            HandleRequest(parser, reader, socketInstance)
+            # a body the handler did not need is skipped as it arrives, the next request starts after it
+            unread = parser.message.contentLength - parser.received
+            if sum(len(chunk) for chunk in reader.ReadChunks(unread)) < unread or parser.message.WantsClose():
+                break
+            idleSince = time.time()
+    finally:
+        socketInstance.Close()
+
+
+def HTTP_overload_handler(stream, socketInstance):
+    # every handler is busy and the queue is full: the first request is answered right away instead of waiting,
+    # its body is not needed
+    try:
+        if HTTPParser().ReadFrom(StreamReader(stream), headOnly=True):
+            SendServiceUnavailable(socketInstance)
+    except ValueError as e:
         print(e)
-        raise Exception("WriteError")
+        SendBadRequest(socketInstance)
+    finally:
+        socketInstance.Close()
 
 
-def HTTP_file_handler(request, socketInstance):
+def HandleRequest(parser, reader, socketInstance):
+    request = parser.message
     if args.v:
-        print("\n****Received Request:****\n" + request)
+        print("\n****Received Request:****\n" + request.head.decode())
 
-        path = ParseRequest(request)["Path"]
-        requestType = ParseRequest(request)["Type"]
+    path = request.path
+    requestType = request.method
 
-        # check if it is requesting a dir other than current dir
-        # HTTP 403
-        if path.count('/') > 1:
-            SendUnauthorized(socketInstance)
-            return
+    # check if it is requesting a dir other than current dir
+    # HTTP 403
+    if path.count('/') > 1:
+        SendUnauthorized(socketInstance)
+        return
 
-        filename = path[1:]
-        fileAddress = crntdir + filename
-
-        # GET
-        if requestType == 'GET':
-
-            # get for dir list
-            if path == '/':
-                fileList = GetDirectoryFileList(crntdir)
-                SendOkResponse(socketInstance, FileList2Body(fileList))
-
-            # get to download a file
-            if path[0] == '/':
-                # check if file exists
-                if pathlib.Path(fileAddress).is_file():
-                    fileData = ReadFromFile(fileAddress)
-                    header = 'Content-Type: text/html; charset=utf-8\r\nContent-Length: ' + str(len(fileData))
-                    body = fileData
-                    SendOkResponse(socketInstance, body, header)
-                else:
-                    SendNotFound(socketInstance)
-
-        elif requestType == 'POST':
-            fileData = ParseRequest(request)["Body"]
-            try:
-                WritetoFile(fileAddress, fileData)
-                SendOkResponse(socketInstance)
-            except:
-                SendInternalServerError(socketInstance)
+    filename = path[1:]
+    fileAddress = crntdir + filename
+
+    # GET
+    if requestType == 'GET':
+
+        # get for dir list
+        if path == '/':
+            SendDirectoryList(socketInstance)
+
+        elif path == STATS_PATH:
+            SendStats(socketInstance)
+
+        # get to download a file
+        elif path[0] == '/':
+            # check if file exists
+            if pathlib.Path(fileAddress).is_file():
+                SendFileResponse(socketInstance, request, path, fileAddress)
+            else:
+                SendNotFound(socketInstance)
+
+    elif requestType == 'POST':
+        if not parser.ReadFrom(reader):
+            return
+        # the upload is stored as sent, it need not be text
+        if args.v:
+            print(str(request.body, 'utf-8', 'replace'))
+        try:
+            WritetoFile(fileAddress, request.body)
+            # the validators would catch the change too, unless it happened within the mtime granularity
+            responseCache.Invalidate(path)
+            responseCache.Invalidate('/')
+            SendOkResponse(socketInstance)
+        except:
+            SendInternalServerError(socketInstance)
 
 
 # Main
@@ -185,6 +444,8 @@ def HTTP_file_handler(request, socketInstance):
 crntdir = os.path.dirname(os.path.abspath(__file__)) + '\\htdocs\\' if args.dir is None else args.dir
 # check port, default: 80
 port = args.port if args.port is not None else 80
+# rendered responses of the hot files and of the directory listing
+responseCache = ResponseCache(args.cache_size)
 
 # Run server
-Run_TCP_listener(port)
+reliserver = Run_TCP_listener(port)
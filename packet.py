@@ -1,14 +1,36 @@
 import ipaddress
+import struct
+from functools import lru_cache
 
 MIN_LEN = 11
 MAX_LEN = 1024
 
+# packet_type (1 byte), seq_num (4 bytes), peer_ip_addr (4 bytes), peer_port (2 bytes), all big-endian
+HEADER = struct.Struct('>BI4sH')
+# seq_num inside HEADER, right after packet_type
+SEQ_NUM = struct.Struct('>I')
+
+
+@lru_cache(maxsize=4096)
+def peer_address(packed):
+    """
+    peer_address returns the (cached) ip_address object of a 4-byte packed IPv4 address.
+    """
+    return ipaddress.ip_address(packed)
+
+
+@lru_cache(maxsize=4096)
+def packed_address(peer_ip_addr):
+    return peer_ip_addr.packed
+
 
 class Packet:
     """
     Packet represents a simulated UDP packet.
     """
 
+    __slots__ = ('packet_type', 'seq_num', 'peer_ip_addr', 'peer_port', 'payload')
+
     def __init__(self, packet_type, seq_num, peer_ip_addr, peer_port, payload):
         self.packet_type = int(packet_type)
         self.seq_num = int(seq_num)
@@ -18,17 +40,22 @@ class Packet:
 
     def to_bytes(self):
         """
-        to_raw returns a bytearray representation of the packet in big-endian order.
+        to_raw returns a bytes representation of the packet in big-endian order.
         """
-        buf = bytearray()
-        buf.extend(self.packet_type.to_bytes(1, byteorder='big'))
-        buf.extend(self.seq_num.to_bytes(4, byteorder='big'))
-        buf.extend(self.peer_ip_addr.packed)
-        buf.extend(self.peer_port.to_bytes(2, byteorder='big'))
+        return HEADER.pack(self.packet_type, self.seq_num, packed_address(self.peer_ip_addr),
+                           self.peer_port) + self.payload
 
-        buf.extend(self.payload)
+    def pack_into(self, buffer, offset=0):
+        """pack_into writes the raw packet into a writable buffer at offset.
 
-        return buf
+            Returns:
+                the number of bytes written.
+        """
+        HEADER.pack_into(buffer, offset, self.packet_type, self.seq_num, packed_address(self.peer_ip_addr),
+                         self.peer_port)
+        end = offset + MIN_LEN + len(self.payload)
+        buffer[offset + MIN_LEN:end] = self.payload
+        return end - offset
 
     def __repr__(self, *args, **kwargs):
         return "#%d, peer=%s:%s, size=%d" % (self.seq_num, self.peer_ip_addr, self.peer_port, len(self.payload))
@@ -38,33 +65,76 @@ class Packet:
         """from_bytes creates a packet from the given raw buffer.
 
             Args:
-                raw: a bytearray that is the raw-representation of the packet in big-endian order.
+                raw: a bytes-like object that is the raw-representation of the packet in big-endian order.
 
             Returns:
-                a packet from the given raw bytes.
+                a packet from the given raw bytes, its payload is a memoryview over raw (no copy).
 
             Raises:
                 ValueError: if packet is too short or too long or invalid peer address.
         """
-        if len(raw) < MIN_LEN:
-            raise ValueError("packet is too short: {} bytes".format(len(raw)))
-        if len(raw) > MAX_LEN:
-            raise ValueError("packet is exceeded max length: {} bytes".format(len(raw)))
-
-        curr = [0, 0]
-
-        def nbytes(n):
-            curr[0], curr[1] = curr[1], curr[1] + n
-            return raw[curr[0]: curr[1]]
-
-        packet_type = int.from_bytes(nbytes(1), byteorder='big')
-        seq_num = int.from_bytes(nbytes(4), byteorder='big')
-        peer_addr = ipaddress.ip_address(nbytes(4))
-        peer_port = int.from_bytes(nbytes(2), byteorder='big')
-        payload = raw[curr[1]:]
-
-        return Packet(packet_type=packet_type,
-                      seq_num=seq_num,
-                      peer_ip_addr=peer_addr,
-                      peer_port=peer_port,
-                      payload=payload)
+        size = len(raw)
+        if size < MIN_LEN:
+            raise ValueError("packet is too short: {} bytes".format(size))
+        if size > MAX_LEN:
+            raise ValueError("packet is exceeded max length: {} bytes".format(size))
+
+        # fields come straight from the struct, skip the conversions of __init__
+        p = Packet.__new__(Packet)
+        p.packet_type, p.seq_num, peer_addr, p.peer_port = HEADER.unpack_from(raw)
+        p.peer_ip_addr = peer_address(peer_addr)
+        p.payload = memoryview(raw)[MIN_LEN:]
+        return p
+
+
+class HeaderTemplate:
+    """
+    HeaderTemplate is the header of the packets of one type that one connection sends to its peer.
+    Only seq_num changes from packet to packet, so it is patched into a reused buffer
+    instead of building and packing a new Packet for every segment.
+    """
+
+    __slots__ = ('buffer',)
+
+    def __init__(self, packet_type, peer_ip_addr, peer_port):
+        self.buffer = bytearray(HEADER.pack(packet_type, 0, packed_address(peer_ip_addr), peer_port))
+
+    def datagram(self, seq_num, payload):
+        """datagram returns the raw packet carrying payload as seq_num.
+
+            The buffer is shared by all the packets of the template, so one thread at a time may use it.
+        """
+        SEQ_NUM.pack_into(self.buffer, 1, seq_num)
+        return self.buffer + payload
+
+
+def encode_batch(packets, buffer=None):
+    """encode_batch encodes packets back to back into one reusable buffer.
+
+        Args:
+            packets: the packets to encode.
+            buffer: a bytearray to reuse, grown when it is too small.
+
+        Returns:
+            the buffer and a list of memoryviews over it, one per encoded packet, ready for sendto.
+    """
+    # every packet fits in MAX_LEN, so the buffer never has to be measured packet by packet
+    if buffer is None or len(buffer) < len(packets) * MAX_LEN:
+        buffer = bytearray(len(packets) * MAX_LEN)
+    view = memoryview(buffer)
+    pack_into = HEADER.pack_into
+    datagrams = []
+    offset = 0
+    for p in packets:
+        pack_into(buffer, offset, p.packet_type, p.seq_num, packed_address(p.peer_ip_addr), p.peer_port)
+        start = offset + MIN_LEN
+        end = start + len(p.payload)
+        buffer[start:end] = p.payload
+        datagrams.append(view[offset:end])
+        offset = end
+    return buffer, datagrams
+
+
+def decode_batch(datagrams):
+    """decode_batch creates a packet from every raw datagram, see Packet.from_bytes."""
+    return [Packet.from_bytes(raw) for raw in datagrams]
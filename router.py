@@ -0,0 +1,223 @@
+##Python counterpart of router.go: dispatches packets between peers over a simulated lossy link##
+import argparse
+import heapq
+import random
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+from packet import HEADER, MAX_LEN, MIN_LEN
+
+# command line arguments
+parser = argparse.ArgumentParser(description='Logical router that dispatches UDP packets between applications, '
+                                             'rewriting the peer address from the destination to the sender')
+parser.add_argument('--port', type=int, default=3000, help='Port the router listens at')
+parser.add_argument('--drop-rate', type=float, default=0.0, help='Probability that a packet is dropped')
+parser.add_argument('--max-delay', type=str, default='0', help='Largest delay of a packet, e.g. 10ms, 1s or 0.5')
+parser.add_argument('--seed', type=int, help='Seed of the random generator, the same seed repeats the same behaviour')
+parser.add_argument('--reorder-rate', type=float, default=0.0,
+                    help='Probability that a packet is held back so that later ones overtake it')
+parser.add_argument('--duplicate-rate', type=float, default=0.0, help='Probability that a packet is delivered twice')
+parser.add_argument('--bandwidth', type=float, help='Link rate in bytes per second, default: unlimited')
+parser.add_argument('--queue-size', type=int, help='Packets the router holds at most, more are dropped')
+parser.add_argument('-v', action='store_true', help='Log every packet')
+
+# hold time of a reordered packet when there is no max delay to go beyond
+REORDER_DELAY = 0.01
+
+# data sequence numbers remembered per flow to count retransmissions: a retransmission stays within the sender's
+# selective-repeat window, twice that is plenty; the flows idle the longest are forgotten beyond SEEN_FLOWS
+SEEN_PER_FLOW = 2048
+SEEN_FLOWS = 1024
+
+
+def ParseDuration(duration):
+    """
+    ParseDuration accepts the durations of router.go (5ms, 2s, 1m) as well as plain seconds.
+    """
+    match = re.fullmatch(r'\s*([0-9.]+)\s*(us|ms|s|m)?\s*', str(duration))
+    if match is None:
+        raise ValueError("invalid duration: {}".format(duration))
+    return float(match.group(1)) * {'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, None: 1}[match.group(2)]
+
+
+class Router:
+    """
+    Router receives packets on one UDP port and forwards each to the peer address in its header,
+    replacing that address with the sender's, exactly like router.go. On the way packets are dropped,
+    delayed, reordered, duplicated, serialized at a limited bandwidth and tail-dropped when the queue is full.
+    Every random decision comes from one seeded generator, taken in arrival order.
+    It runs in two daemon threads, so it can be started in-process by tests and benchmarks.
+    """
+
+    def __init__(self, port=3000, dropRate=0.0, maxDelay=0.0, seed=None, reorderRate=0.0, duplicateRate=0.0,
+                 bandwidth=None, queueSize=None, verbose=False):
+        self.port = port
+        self.dropRate = dropRate
+        self.maxDelay = maxDelay
+        self.seed = seed if seed is not None else time.time_ns()
+        self.random = random.Random(self.seed)
+        self.reorderRate = reorderRate
+        self.duplicateRate = duplicateRate
+        self.bandwidth = bandwidth
+        self.queueSize = queueSize
+        self.verbose = verbose
+        self.connection = None
+        self.running = False
+        # (departure time, arrival number, raw, destination) min-heap of the packets in the router
+        self.queue = []
+        self.arrivals = 0
+        # when the simulated link finishes serializing the packets already queued
+        self.linkFreeAt = 0
+        self.condition = threading.Condition()
+        # (sender, destination) -> (set, deque in arrival order) of the recent data seq_nums, to count retransmissions
+        self.seenData = OrderedDict()
+        self.stats = {'received': 0, 'delivered': 0, 'dropped': 0, 'overflowed': 0, 'duplicated': 0,
+                      'reordered': 0, 'invalid': 0, 'retransmitted': 0, 'bytes': 0, 'types': {}}
+
+    def Start(self):
+        self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.connection.bind(('', self.port))
+        # port 0 picks a free one
+        self.port = self.connection.getsockname()[1]
+        # wakes the reception thread up regularly so that Stop does not wait for a packet
+        self.connection.settimeout(0.2)
+        self.running = True
+        threading.Thread(target=self.ReceptionHandler, daemon=True).start()
+        threading.Thread(target=self.DeliveryHandler, daemon=True).start()
+        return self
+
+    def Stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.connection.close()
+
+    def Stats(self):
+        with self.condition:
+            stats = dict(self.stats)
+            stats['types'] = dict(self.stats['types'])
+            stats['queued'] = len(self.queue)
+            return stats
+
+    def Log(self, message):
+        if self.verbose:
+            print(time.strftime('%H:%M:%S'), message)
+
+    def Route(self, raw, sender):
+        """
+        Route rewrites a raw packet for delivery and returns it with its destination, or None if it is invalid.
+        """
+        if len(raw) < MIN_LEN or len(raw) > MAX_LEN:
+            return None
+        packetType, seqNum, peerAddress, peerPort = HEADER.unpack_from(raw)
+        destinationIp = socket.inet_ntoa(peerAddress)
+        # a loopback destination is on the same host as the sender
+        if destinationIp.startswith('127.'):
+            destinationIp = sender[0]
+        routed = HEADER.pack(packetType, seqNum, socket.inet_aton(sender[0]), sender[1]) + raw[MIN_LEN:]
+        return routed, (destinationIp, peerPort), packetType, seqNum
+
+    def ReceptionHandler(self):
+        while self.running:
+            try:
+                raw, sender = self.connection.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                # closed by Stop
+                break
+            with self.condition:
+                self.Process(raw, sender)
+
+    def Process(self, raw, sender):
+        # callers hold the condition
+        self.stats['received'] += 1
+        routed = self.Route(raw, sender)
+        if routed is None:
+            self.stats['invalid'] += 1
+            return
+        routed, destination, packetType, seqNum = routed
+        self.stats['types'][packetType] = self.stats['types'].get(packetType, 0) + 1
+        if packetType == 0:
+            self.SeeData(sender, destination, seqNum)
+
+        if self.random.random() < self.dropRate:
+            self.stats['dropped'] += 1
+            self.Log("packet #%d %s -> %s is dropped" % (seqNum, sender, destination))
+            return
+        copies = 2 if self.random.random() < self.duplicateRate else 1
+        self.stats['duplicated'] += copies - 1
+        for copy in range(copies):
+            if self.queueSize is not None and len(self.queue) >= self.queueSize:
+                self.stats['overflowed'] += 1
+                self.Log("packet #%d %s -> %s overflows the queue" % (seqNum, sender, destination))
+                continue
+            self.Schedule(routed, destination, seqNum)
+
+    def SeeData(self, sender, destination, seqNum):
+        # callers hold the condition
+        flow = (sender, destination)
+        seen = self.seenData.get(flow)
+        if seen is None:
+            seen = self.seenData[flow] = (set(), deque())
+            if len(self.seenData) > SEEN_FLOWS:
+                self.seenData.popitem(last=False)
+        else:
+            self.seenData.move_to_end(flow)
+        seqNums, order = seen
+        if seqNum in seqNums:
+            self.stats['retransmitted'] += 1
+            return
+        seqNums.add(seqNum)
+        order.append(seqNum)
+        if len(order) > SEEN_PER_FLOW:
+            seqNums.discard(order.popleft())
+
+    def Schedule(self, routed, destination, seqNum):
+        now = time.monotonic()
+        departure = now
+        if self.bandwidth:
+            # the link sends one packet after the other at the given rate
+            self.linkFreeAt = max(self.linkFreeAt, now) + len(routed) / self.bandwidth
+            departure = self.linkFreeAt
+        delay = self.random.random() * self.maxDelay
+        if self.random.random() < self.reorderRate:
+            self.stats['reordered'] += 1
+            delay += max(self.maxDelay, REORDER_DELAY)
+        self.arrivals += 1
+        heapq.heappush(self.queue, (departure + delay, self.arrivals, routed, destination))
+        self.condition.notify()
+        self.Log("[queue=%d] packet #%d -> %s is delayed for %.3fs" % (
+            len(self.queue), seqNum, destination, departure + delay - now))
+
+    def DeliveryHandler(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.queue or self.queue[0][0] > time.monotonic()):
+                    self.condition.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                if not self.running:
+                    return
+                departure, arrival, routed, destination = heapq.heappop(self.queue)
+                self.stats['delivered'] += 1
+                self.stats['bytes'] += len(routed)
+            try:
+                self.connection.sendto(routed, destination)
+            except OSError as e:
+                self.Log("failed to deliver to %s: %s" % (destination, e))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    router = Router(args.port, args.drop_rate, ParseDuration(args.max_delay), args.seed, args.reorder_rate,
+                    args.duplicate_rate, args.bandwidth, args.queue_size, args.v).Start()
+    print("router is listening at port %d, drop-rate=%.2f, max-delay=%.3fs, seed=%d" % (
+        router.port, router.dropRate, router.maxDelay, router.seed))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        router.Stop()
+        print(router.Stats())